@@ -1,293 +1,285 @@
-import json, os, ast, smtplib, bcrypt
+import io, re, bcrypt, logging, threading, zipfile
 from datetime import datetime, timedelta
 import streamlit as st
 import pandas as pd
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
-from io import BytesIO
-from email.message import EmailMessage
-from reportlab.lib import colors
-from reportlab.lib.units import mm
-from reportlab.platypus import Table, TableStyle, Paragraph, SimpleDocTemplate, Spacer
-from reportlab.lib.styles import ParagraphStyle
-from reportlab.lib.enums import TA_LEFT, TA_RIGHT
-import gspread
-from google.oauth2.service_account import Credentials
-
-
-import gspread
-from google.oauth2.service_account import Credentials
-
-DB_SHEETS = {
-    "Users": ["FullName","PasswordHash","Email","IsActive"],
-    "Equipment": ["Type","Brand","Model","Serial","Notes"],
-    "Templates": ["Template","Type","Brand","Model"],
-    "TemplateItems": ["Template","Item","Instruction"],
-    "Inspections": ["Timestamp","User","Action","Type","Brand","Model","Serial","ResultsJSON","Comment","NextDate","PdfPath","Recipients"],
-    "Logins": ["Timestamp","User","Action","Equipment","NextDate"],
-}
-
-def _gcp_creds():
-    gcp_info = dict(st.secrets["gcp"])   # same as in your test app
-    scopes = [
-        "https://www.googleapis.com/auth/spreadsheets",
-        "https://www.googleapis.com/auth/drive.readonly",  # drive not used, but ok
-    ]
-    return Credentials.from_service_account_info(gcp_info, scopes=scopes)
-
-@st.cache_resource
-def _gsheet_client():
-    creds = _gcp_creds()
-    gc = gspread.authorize(creds)
-    sheet_id = st.secrets["app"]["spreadsheet_id"]
-    return gc.open_by_key(sheet_id)
-
-def read_sheet(name: str) -> pd.DataFrame:
-    """Read a tab from the KMA_DB Google Sheet into a DataFrame."""
-    sh = _gsheet_client()
-    ws = sh.worksheet(name)
-    records = ws.get_all_records()
-    df = pd.DataFrame(records)
-    # ensure all expected columns exist, even for empty sheets
-    for col in DB_SHEETS[name]:
-        if col not in df.columns:
-            df[col] = ""
-    return df[DB_SHEETS[name]]
-
-def write_sheet(name: str, df: pd.DataFrame) -> None:
-    """Overwrite a tab in the KMA_DB Google Sheet from a DataFrame."""
-    sh = _gsheet_client()
-    ws = sh.worksheet(name)
-    df = df.copy()
-    df = df.fillna("")
-    values = [df.columns.tolist()] + df.astype(str).values.tolist()
-    ws.clear()
-    ws.update(values)
+from streamlit.runtime.scriptrunner import add_script_run_ctx
+from storage import (read_sheet, read_sheets, append_sheet, lookup, norm, sser, invalidate_sheet,
+                     sheet_cache_stats)
+from catalog import equipment_index, upsert_equipment, get_checklist
+from mailer import queue_email, outbox_worker
+from history import results_to_json, due_status, inspections
+from archive import ARCHIVE_PREFIX, archive_put, archive_get, archive_ref
+from journal import journal_append, journal_enabled, journal_flusher, journal_status
+from scheduler import sheets_scheduler, SheetsBusyError
+from perf import (perf_enabled, timed, start_rerun, end_rerun, op_stats, rerun_stats,
+                  reset_perf)
 
 
 def add_user(fullname, password, email=""):
-    users = read_sheet("Users")
-    if (users["FullName"].str.lower().str.strip() == fullname.lower().strip()).any():
+    if not lookup("Users", {"FullName": fullname}).empty:
         return False, "User already exists."
     salt = bcrypt.gensalt()
     pw_hash = bcrypt.hashpw(password.encode("utf-8"), salt).decode("utf-8")
     new = {"FullName": fullname.strip(), "PasswordHash": pw_hash, "Email": email, "IsActive": True}
-    users = pd.concat([users, pd.DataFrame([new])], ignore_index=True)
-    write_sheet("Users", users)
+    append_sheet("Users", [new])
     return True, "User created."
 
+def _truthy(v):  # sheet cells come back as "TRUE"/"False"/1/"" depending on backend
+    return str(v).strip().lower() not in ("", "false", "0", "no", "nej", "nan", "none")
+
+@timed("authenticate")
 def authenticate(fullname, password):
-    users = read_sheet("Users")
-    row = users[users["FullName"].str.lower().str.strip() == fullname.lower().strip()]
+    row = lookup("Users", {"FullName": fullname})
     if row.empty:
         return False, "USER_NOT_FOUND"
-    if not bool(row.iloc[0]["IsActive"]):
+    if not _truthy(row.iloc[0]["IsActive"]):
         return False, "INACTIVE"
-    ok = bcrypt.checkpw(password.encode("utf-8"), row.iloc[0]["PasswordHash"].encode("utf-8"))
+    ok = bcrypt.checkpw(password.encode("utf-8"), str(row.iloc[0]["PasswordHash"]).encode("utf-8"))
     return (True, "") if ok else (False, "BAD_PASSWORD")
 
-def upsert_equipment(rec):
-    eq = read_sheet("Equipment")
-
-    def norm(x):  # normalize a single value
-        return str(x or "").strip().lower()
-
-    def sser(s):  # normalize a pandas Series (handles NaN / numbers)
-        return s.fillna("").astype(str).str.strip().str.lower()
-
-    # Ensure the 4 columns exist (in case of a fresh/empty sheet)
-    for col in ["Type", "Brand", "Model", "Serial", "Notes"]:
-        if col not in eq.columns:
-            eq[col] = ""
-
-    # Build a normalized mask (case/space insensitive, robust to numeric cells)
-    mask = (
-        (sser(eq["Type"])   == norm(rec.get("Type")))   &
-        (sser(eq["Brand"])  == norm(rec.get("Brand")))  &
-        (sser(eq["Model"])  == norm(rec.get("Model")))  &
-        (sser(eq["Serial"]) == norm(rec.get("Serial")))
-    )
 
-    if mask.any():
-        # Update notes only (no duplicate row)
-        idx = eq[mask].index[0]
-        eq.loc[idx, "Notes"] = rec.get("Notes", "")
-    else:
-        # Always write as strings to preserve leading zeros in Serial
-        new = {
-            "Type":   str(rec.get("Type", "")),
-            "Brand":  str(rec.get("Brand", "")),
-            "Model":  str(rec.get("Model", "")),
-            "Serial": str(rec.get("Serial", "")),
-            "Notes":  str(rec.get("Notes", "")),
-        }
-        eq = pd.concat([eq, pd.DataFrame([new])], ignore_index=True)
-
-    write_sheet("Equipment", eq)
-
-
-def get_checklist(t, b, m):
-    tpls = read_sheet("Templates")
-    items = read_sheet("TemplateItems")
-    def sser(s):  # safe string-normalization for Series
-        return s.fillna("").astype(str).str.strip().str.lower()
-
-    tt, bb, mm = t.strip().lower(), b.strip().lower(), m.strip().lower()
-    hit = tpls[(sser(tpls["Type"]) == tt) &
-               (sser(tpls["Brand"]) == bb) &
-               (sser(tpls["Model"]) == mm)]
-    if hit.empty:
-        return None, []
-    tpl = hit.iloc[0]["Template"]
-    rows = items[items["Template"]==tpl][["Item","Instruction"]].to_dict(orient="records")
-    return tpl, rows
-
-
-def gen_pdf(report_dict) -> bytes:
-    buf = BytesIO()
-
-    # Document
-    doc = SimpleDocTemplate(
-        buf, pagesize=A4,
-        leftMargin=18*mm, rightMargin=18*mm,
-        topMargin=16*mm, bottomMargin=14*mm
-    )
-
-    # Styles
-    h1  = ParagraphStyle('h1', fontName='Helvetica-Bold', fontSize=16, leading=18, spaceAfter=6)
-    h2  = ParagraphStyle('h2', fontName='Helvetica-Bold', fontSize=12, leading=14, spaceAfter=6)
-    txt = ParagraphStyle('txt', fontName='Helvetica', fontSize=10, leading=12)
-    small = ParagraphStyle('small', fontName='Helvetica', fontSize=9, leading=11)
-    right = ParagraphStyle('right', parent=small, alignment=TA_RIGHT)
-
-    story = []
-
-    # Header
-    story.append(Paragraph("Nordic Maskin & Rail.", h2))
-    story.append(Paragraph("Krumtappen 5, 6580 Vamdrup", txt))
-    story.append(Paragraph("CVR. 36078405", txt))
-    story.append(Spacer(1, 6))
-
-    title = "Kalibreringscertifikat" if report_dict["Action"].lower().startswith("kalibr") else "Service inspektionsrapport"
-    story.append(Paragraph(title, h1))
-    story.append(Spacer(1, 6))
-
-    # Equipment fields
-    fields = [
-        ("Udstyr.",  f"{report_dict['Type']}"),
-        ("Fabrikat.",f"{report_dict['Brand']}"),
-        ("Serie nr.",f"{report_dict['Model']}"),  # swap to Serial if you prefer
-        ("Bemærkning", report_dict.get("Comment","")),
-    ]
-    t = Table(
-        [[Paragraph(f"<b>{k}</b>", txt), Paragraph(v or "", txt)] for k,v in fields],
-        colWidths=[30*mm, 140*mm], hAlign='LEFT'
-    )
-    t.setStyle(TableStyle([('VALIGN',(0,0),(-1,-1),'TOP'), ('BOTTOMPADDING',(0,0),(-1,-1),4)]))
-    story.append(t)
-    story.append(Spacer(1, 4))
-
-    # 3-column line
-    cal_to = report_dict.get("CalibratedTo","")
-    ordno  = report_dict.get("OrderNo","")
-    kdate  = report_dict["Timestamp"].split(" ")[0]
-    tri = [
-        [Paragraph("<b>Kalibreret til.</b>", txt),
-         Paragraph("<b>Ordre nr.</b>", txt),
-         Paragraph("<b>Kalibreret Dato</b>", txt)],
-        [Paragraph(cal_to or "", txt),
-         Paragraph(ordno or "", txt),
-         Paragraph(kdate, txt)]
-    ]
-    t3 = Table(tri, colWidths=[50*mm, 40*mm, 40*mm])
-    t3.setStyle(TableStyle([
-        ('BOX',(0,0),(-1,-1),0.3,colors.black),
-        ('INNERGRID',(0,0),(-1,-1),0.3,colors.black),
-        ('BACKGROUND',(0,0),(-1,0), colors.whitesmoke),
-        ('VALIGN',(0,0),(-1,-1),'MIDDLE'),
-        ('ALIGN',(0,0),(-1,0),'CENTER'),
-    ]))
-    story.append(t3)
-    story.append(Spacer(1, 8))
-
-    # Checklist
-    def map_status(s):
-        return {"green":"OK", "yellow":"ATTENTION", "red":"NOT OK"}.get((s or "").lower(), "-")
-
-    cl_rows = []
-    for r in report_dict["Results"]:
-        left = f"- {r['item']}"
-        note = r.get('note') or ""
-        if note: left += f" — {note}"
-        cl_rows.append([Paragraph(left, txt), Paragraph(map_status(r.get('status')), right)])
-
-    if cl_rows:
-        cl = Table(cl_rows, colWidths=[130*mm, 40*mm], hAlign='LEFT')
-        cl.setStyle(TableStyle([
-            ('VALIGN',(0,0),(-1,-1),'TOP'),
-            ('ALIGN',(1,0),(1,-1),'RIGHT'),
-            ('BOTTOMPADDING',(0,0),(-1,-1),3),
-        ]))
-        story.append(cl)
-        story.append(Spacer(1, 6))
-
-    # Banedanmark note
-    bd_text = ("Udstysr kalibreres if. GAB-Banedanmark anlæg & fornyelse. "
-               "General arbejdsbeskrivelse for sporarbejde.(GAB spor) udgave 14 af. "
-               "D.4-4-2016 pct. 2.6.1.1")
-    story.append(Paragraph(bd_text, small))
-    story.append(Spacer(1, 8))
-
-    # Next date + Kontrolleret af
-    story.append(Paragraph(f"Næste kontrol dato: {report_dict['NextDate']}", h2))
-    story.append(Paragraph(f"Kontrolleret af: {report_dict['User']}", h2))
-    story.append(Spacer(1, 14))
-
-    # Footer
-    story.append(Paragraph("Revision 03-03-2022  Udarbejdet: SH    Kontrolleret: TJ    Godkendt: DCS", small))
-
-    doc.build(story)
+# ----------------- UI -----------------
+CHECKLIST_PAGE_SIZE = 15  # items per page of the step 4 form
+
+def _preset_index(options, value):
+    return options.index(value) if value in options else (0 if options else None)
+
+def _apply_serial_hit():
+    # runs before the rerun: drop the selector state so the picked path becomes their index
+    hit = st.session_state.get("serial_hits", {}).get(st.session_state.get("serial_hit"))
+    if hit:
+        for k in ("sel_type", "sel_brand", "sel_model", "sel_serial"):
+            st.session_state.pop(k, None)
+        st.session_state.serial_pick = hit
+
+def _is_admin(user) -> bool:
+    return bool(user) and norm(user) in {norm(a) for a in st.secrets.get("app", {}).get("admins", [])}
+
+def _sheets_busy(e: SheetsBusyError):
+    """Show the quota message with a retry button and end this run."""
+    st.error(str(e))
+    st.button("Prøv igen")
+    end_rerun()
+    st.stop()
+
+def _report_history():
+    """Recent inspections with their archived PDF for download or re-send."""
+    from report_pdf import gen_pdf, inspection_to_report, inspection_filename  # ReportLab loads on first use
+    insp = inspections()
+    q = st.text_input("Søg serienr.", key="hist_serial")
+    if q:
+        insp = insp[sser(insp["Serial"]).str.contains(norm(q), regex=False)]
+    recent = insp.sort_values("Timestamp", ascending=False).head(20)
+    labels = {f"{str(r.Timestamp)[:16]} — {r.Type} / {r.Brand} / {r.Model} / {r.Serial} ({r.Action})": i
+              for i, r in zip(recent.index, recent.itertuples())}
+    pick = st.selectbox(f"Rapport ({len(labels)} seneste)", list(labels), index=None, key="hist_pick")
+    if not pick:
+        return
+    row_id = labels[pick]
+    row = insp.loc[row_id]
+    ref = str(row["PdfPath"] or "")
+    pdf = archive_get(ref) if ref.startswith(ARCHIVE_PREFIX) else None
+    rebuilt = pdf is None
+    if rebuilt:  # not archived, or evicted: render from the log, which may differ from what was sent
+        pdf = gen_pdf(inspection_to_report(read_sheet("Inspections").iloc[row_id].to_dict()))
+        st.warning("Ikke i arkivet — PDF'en er genskabt fra loggen og er ikke nødvendigvis "
+                   "identisk med det sendte certifikat (ældre rapporter mangler f.eks. "
+                   "Kalibreret til / Ordre nr.).")
+    meta = {k: str(row[k]) for k in ("Action", "Type", "Brand", "Model", "Serial")}
+    meta["Timestamp"] = str(row["Timestamp"])[:16]
+    name = inspection_filename(meta)
+    c1, c2 = st.columns(2)
+    c1.download_button("Hent PDF", pdf, file_name=name, mime="application/pdf", use_container_width=True)
+    recipients = [r.strip() for r in str(row["Recipients"] or "").split(",") if r.strip()] \
+        or st.secrets.get("app", {}).get("default_recipients", [])
+    confirmed = not rebuilt or st.checkbox("Send alligevel den genskabte PDF", key="hist_resend_rebuilt")
+    if c2.button("Send igen", use_container_width=True, disabled=not recipients or not confirmed):
+        queue_email(recipients, f"Rapport (kopi): {meta['Action']} — {meta['Type']}/{meta['Brand']}/"
+                    f"{meta['Model']}/{meta['Serial']}", f"Se vedhæftet PDF.\n\nDato: {meta['Timestamp']}",
+                    pdf, name)
+        st.success(f"Lagt i kø til {', '.join(recipients)}.")
+
+def _perf_page():
+    st.subheader("Performance")
+    st.caption("Since process start (or last reset). Times in ms; API calls are Google Sheets round trips.")
+    st.markdown("**Operations**")
+    st.dataframe(op_stats(), hide_index=True, use_container_width=True)
+    st.markdown("**Reruns per step**")
+    st.dataframe(rerun_stats(), hide_index=True, use_container_width=True)
+    st.markdown("**Sheet cache**")
+    st.dataframe(sheet_cache_stats(), hide_index=True, use_container_width=True)
+    st.markdown("**Sheets API scheduler** (coalesced reads, quota waits, retries)")
+    st.dataframe(pd.DataFrame([sheets_scheduler().stats]), hide_index=True, use_container_width=True)
+    if st.button("Reset counters"):
+        reset_perf()
+
+def _inspection_row(report, pdf_path, recipients) -> dict:
+    """The Inspections log row for a submitted report."""
+    row = {k: report[k] for k in ("Timestamp","User","Action","Type","Brand","Model","Serial")}
+    row.update({"ResultsJSON": results_to_json(report["Results"]), "Comment": report["Comment"],
+                "NextDate": report["NextDate"], "PdfPath": pdf_path, "Recipients": ", ".join(recipients),
+                "CalibratedTo": report["CalibratedTo"], "OrderNo": report["OrderNo"]})
+    return row
+
+def _login_row(report) -> dict:
+    return {
+        "Timestamp": report["Timestamp"],
+        "User": report["User"],
+        "Action": report["Action"],
+        "Equipment": f"{report['Type']}/{report['Brand']}/{report['Model']}/{report['Serial']}",
+        "NextDate": report["NextDate"],
+    }
+
+def _zip_files(files) -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as zf:  # PDFs are already compressed
+        for name, data in files:
+            zf.writestr(name, data)
     return buf.getvalue()
 
+def _batch_checklist():
+    """Step 4 for several serials of one model: one grid of items x serials, submitted once."""
+    sel = st.session_state.selection
+    serials = sel["Serials"]
+    st.subheader(f"Tjekliste — {sel['Type']} / {sel['Brand']} / {sel['Model']} — {len(serials)} stk.")
+    key = (sel["Type"], sel["Brand"], sel["Model"], tuple(serials))
+    pin = st.session_state.get("checklist")
+    if not pin or pin["key"] != key:
+        try:
+            tpl, rows = get_checklist(sel["Type"], sel["Brand"], sel["Model"])
+        except SheetsBusyError as e:
+            _sheets_busy(e)
+        grid = pd.DataFrame([{"Serienr.": s, "Punkt": r["Item"], "Status": "green", "Note": ""}
+                             for s in serials for r in rows], columns=["Serienr.","Punkt","Status","Note"])
+        pin = st.session_state.checklist = {"key": key, "tpl": tpl, "rows": rows, "grid": grid}
+    rows = pin["rows"]
+    if not rows:
+        st.error("Ingen tjekliste for denne kombination. Tilføj i Templates/TemplateItems.")
+        if st.button("Tilbage"):
+            st.session_state.step = 3
+            st.session_state.pop("checklist", None)
+        return
+
+    with st.form("batch_form"):
+        st.caption("Alle punkter står til green — ret kun dem, der afviger. "
+                   "Kalibreret til, ordre nr., kommentar og næste dato gælder for alle.")
+        grid = st.data_editor(
+            pin["grid"], key="batch_grid", hide_index=True, use_container_width=True, num_rows="fixed",
+            disabled=["Serienr.", "Punkt"],
+            column_config={"Status": st.column_config.SelectboxColumn(
+                "Status", options=["green","yellow","red"], required=True)},
+        )
+        cal_to = st.text_input("Kalibreret til", placeholder="f.eks. 150Nm", key="batch_cal_to")
+        order_no = st.text_input("Ordre nr.", placeholder="f.eks. 1/11", key="batch_order_no")
+        comment = st.text_area("Kommentar", key="batch_comment")
+        next_date = st.date_input("Næste dato", value=(datetime.today() + timedelta(days=365)).date(),
+                                  key="batch_next_date")
+        confirm = st.form_submit_button(f"Bekræft og generér {len(serials)} rapporter")
+
+    c1, c3 = st.columns(2)
+    if c1.button("Tilbage"):
+        st.session_state.step = 3
+        st.session_state.pop("checklist", None)
+    if confirm:
+        _submit_batch(sel, rows, grid, cal_to, order_no, comment, next_date)
+    if c3.button("Close app"):
+        st.stop()
 
+def _submit_batch(sel, rows, grid, cal_to, order_no, comment, next_date):
+    """One report per serial: PDFs rendered together, one mail, one log append per tab."""
+    ts = datetime.now().strftime("%Y-%m-%d %H:%M")
+    app_cfg = st.secrets.get("app", {})
+    recipients = app_cfg.get("default_recipients", [])
+    if not recipients:
+        st.warning("Ingen modtagere er konfigureret. Tilføj [app].default_recipients i Streamlit secrets.")
+
+    reports = []
+    for serial in sel["Serials"]:
+        # look answers up by serial and item, so sorting the grid cannot mix them up
+        mine = grid[grid["Serienr."].astype(str) == serial]
+        answers = {}  # item -> [(status, note)], in order (an item may repeat in a template)
+        for item, status, note in zip(mine["Punkt"].astype(str), mine["Status"], mine["Note"]):
+            answers.setdefault(item, []).append((status, note))
+        results = []
+        for r in rows:
+            status, note = (answers.get(str(r["Item"])) or [("green", "")]).pop(0)
+            results.append({"item": r["Item"], "instruction": r.get("Instruction", ""),
+                            "status": str(status or "green"), "note": "" if note is None else str(note)})
+        reports.append({
+            "Timestamp": ts, "User": st.session_state.user, "Action": st.session_state.action,
+            "Type": sel["Type"], "Brand": sel["Brand"], "Model": sel["Model"], "Serial": serial,
+            "Results": results, "Comment": comment, "NextDate": str(next_date),
+            "CalibratedTo": cal_to, "OrderNo": order_no,
+        })
+
+    # rendered here, one after the other (~15 ms each): worker processes would re-run this script
+    from report_pdf import gen_pdf, pdf_filename  # usually preloaded by _warm_up
+    with st.spinner(f"Genererer {len(reports)} PDF'er..."):
+        pdfs = [gen_pdf(r) for r in reports]
+    files = [(pdf_filename(r), pdf) for r, pdf in zip(reports, pdfs)]
+
+    paths = []
+    for report, pdf in zip(reports, pdfs):
+        try:
+            key = archive_put(report, pdf)
+            paths.append(archive_ref(key) if key else "")
+        except Exception as e:
+            st.warning(f"Kunne ikke arkivere PDF for {report['Serial']}: {e}")
+            paths.append("")
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    zip_name = re.sub(r'[\\/:*?"<>|]+', "-", f"{sel['Model']}_{len(files)}stk_{stamp}") + ".zip"
+    zipped = _zip_files(files)
+    st.info(f"{len(files)} PDF'er genereret" + (" og arkiveret." if any(paths) else "."))
+    st.download_button("Hent alle PDF'er (zip)", zipped, file_name=zip_name, mime="application/zip")
+
+    if recipients:
+        # one mail for the whole batch; large batches as a single zip
+        attachments = [(zip_name, zipped)] if len(files) > int(app_cfg.get("batch_zip_over", 10)) else files
+        try:
+            queue_email(
+                recipients=recipients,
+                subject=(f"Rapporter: {st.session_state.action} — "
+                         f"{sel['Type']}/{sel['Brand']}/{sel['Model']} ({len(files)} stk.)"),
+                body=(f"Se vedhæftede PDF'er.\n\n"
+                      f"Serienr.: {', '.join(map(str, sel['Serials']))}\n"
+                      f"Bruger: {st.session_state.user}\n"
+                      f"Dato: {ts}"),
+                attachments=attachments,
+            )
+            st.success("PDF'erne er lagt i kø til afsendelse på e-mail.")
+        except Exception as e:
+            st.warning(f"E-mail kunne ikke sendes: {e}")
 
-def send_email(recipients, subject, body, pdf_bytes, filename):
-    """
-    Send a PDF as e-mail attachment using SMTP settings from st.secrets['smtp'].
-    """
-    smtp_cfg = st.secrets["smtp"]  # will raise a clear error if [smtp] is missing
-
-    host         = smtp_cfg["host"]
-    port         = int(smtp_cfg.get("port", 587))
-    user         = smtp_cfg["user"]
-    password     = smtp_cfg["password"]
-    sender_email = smtp_cfg.get("sender_email", user)
-    sender_name  = smtp_cfg.get("sender_name", "KMA App")
-
-    msg = EmailMessage()
-    msg["Subject"] = subject
-    msg["From"] = f"{sender_name} <{sender_email}>"
-    msg["To"] = ", ".join(recipients)
-    msg.set_content(body)
-
-    # Attach PDF
-    msg.add_attachment(
-        pdf_bytes,
-        maintype="application",
-        subtype="pdf",
-        filename=filename,
-    )
+    journal_append("Inspections", [_inspection_row(r, p, recipients) for r, p in zip(reports, paths)])
+    journal_append("Logins", [_login_row(r) for r in reports])
 
-    # Send
-    with smtplib.SMTP(host, port) as s:
-        s.starttls()
-        s.login(user, password)
-        s.send_message(msg)
+    st.session_state.results = [r["Results"] for r in reports]
+    st.session_state.pop("checklist", None)
+    st.session_state.step = 5
 
+@st.cache_resource
+def _warm_up():
+    """Once per process, in the background: connect, load the tabs the first
+    screens need and import ReportLab, so the first login doesn't pay for it."""
+    def run():
+        try:
+            read_sheets(["Users", "Equipment", "Templates", "TemplateItems"])
+            import report_pdf  # noqa: F401
+        except Exception:
+            logging.getLogger("kma").exception("warm-up failed")
+    t = threading.Thread(target=run, name="kma-warmup", daemon=True)
+    add_script_run_ctx(t)  # it calls st.cache_resource functions (client, cache, scheduler)
+    t.start()
+    return t
 
-# ----------------- UI -----------------
 st.set_page_config(page_title="KMA — Kalibrering / Service", page_icon="🧰", layout="centered")
+_warm_up()
+
 
+if "smtp" in st.secrets:
+    outbox_worker()  # deliver anything still queued from a previous run
+if journal_enabled():
+    journal_flusher()  # replay entries a previous run did not get to the Sheet
 
 if "step" not in st.session_state:
     st.session_state.step = 1
@@ -300,8 +292,28 @@ if "selection" not in st.session_state:
 if "results" not in st.session_state:
     st.session_state.results = []
 
+start_rerun(st.session_state.step)
+
 st.title("KMA — Kalibrering / Service")
 
+if st.secrets.get("app", {}).get("show_cache_stats", False):
+    with st.sidebar.expander("Sheet cache"):
+        st.dataframe(sheet_cache_stats(), hide_index=True)
+        if st.button("Clear cache"):
+            invalidate_sheet()
+
+if journal_enabled():
+    pending = journal_status()
+    if pending["pending"]:
+        st.sidebar.warning(f"{pending['pending']} registreringer venter på at blive gemt i arket."
+                           + (f" Sidste fejl: {pending['last_error']}" if pending["last_error"] else ""))
+
+if perf_enabled() and _is_admin(st.session_state.user):
+    if st.sidebar.toggle("Performance", key="perf_page"):
+        _perf_page()
+        end_rerun()
+        st.stop()
+
 # ---- Step 1: Login / Sign up ----
 if st.session_state.step == 1:
     st.subheader("Login")
@@ -309,7 +321,10 @@ if st.session_state.step == 1:
     pw = st.text_input("Password", type="password")
     c1, c2 = st.columns(2)
     if c1.button("Login", use_container_width=True):
-        ok, reason = authenticate(name, pw)
+        try:
+            ok, reason = authenticate(name, pw)
+        except SheetsBusyError as e:
+            ok, reason = False, str(e)
         if ok:
             st.session_state.user = name.strip()
             st.session_state.step = 2
@@ -327,7 +342,10 @@ if st.session_state.step == 1:
         if not new_name or not new_pw:
             st.warning("Name and password are required.")
         else:
-            ok, msg = add_user(new_name, new_pw, new_email)
+            try:
+                ok, msg = add_user(new_name, new_pw, new_email)
+            except SheetsBusyError as e:
+                _sheets_busy(e)
             (st.success if ok else st.error)(msg)
 
 # ---- Step 2: Choose action ----
@@ -340,21 +358,63 @@ elif st.session_state.step == 2:
     if c2.button("Service inspektion", use_container_width=True):
         st.session_state.action = "Service inspektion"; st.session_state.step = 3
 
+    # the dashboard reads the whole Inspections log, so only when asked for
+    due = None
+    if st.toggle("Vis kalibreringsstatus og tidligere rapporter", key="show_dashboard"):
+        try:
+            due = due_status()
+        except SheetsBusyError as e:
+            st.error(str(e))
+    if due is not None:
+        overdue, soon = (due["Status"] == "overdue").sum(), (due["Status"] == "due").sum()
+        with st.expander(f"Kalibreringsstatus — {overdue} overskredet, {soon} forfalder snart", expanded=bool(overdue)):
+            m1, m2, m3 = st.columns(3)
+            m1.metric("Overskredet", int(overdue))
+            m2.metric("Forfalder snart", int(soon))
+            m3.metric("OK", int((due["Status"] == "ok").sum()))
+            urgent = due[due["Status"].isin(["overdue", "due"])]
+            if urgent.empty:
+                st.caption("Intet udstyr er overskredet eller forfalder snart.")
+            else:
+                st.dataframe(urgent[["Status","DaysLeft","NextDate","Type","Brand","Model","Serial","LastInspection","LastUser"]],
+                             hide_index=True, use_container_width=True)
+        with st.expander("Tidligere rapporter"):
+            try:
+                _report_history()
+            except SheetsBusyError as e:
+                _sheets_busy(e)
+
 # ---- Step 3: Equipment selection / add new ----
 elif st.session_state.step == 3:
-    eq = read_sheet("Equipment")
-    types = sorted(eq["Type"].dropna().unique().tolist())
+    try:
+        idx = equipment_index()
+    except SheetsBusyError as e:
+        _sheets_busy(e)
+    pick = st.session_state.pop("serial_pick", None) or (None,) * 4
+    types = idx.options()
 
     st.subheader("Udstyr")
     c1, c2 = st.columns([3,1])
     with c1:
-        t = st.selectbox("Type", types, index=0 if types else None, key="sel_type")
-        brands = sorted(eq[eq["Type"]==t]["Brand"].dropna().unique().tolist()) if t else []
-        b = st.selectbox("Mærke", brands, index=0 if brands else None, key="sel_brand")
-        models = sorted(eq[(eq["Type"]==t)&(eq["Brand"]==b)]["Model"].dropna().unique().tolist()) if b else []
-        m = st.selectbox("Model", models, index=0 if models else None, key="sel_model")
-        serials = sorted(eq[(eq["Type"]==t)&(eq["Brand"]==b)&(eq["Model"]==m)]["Serial"].dropna().unique().tolist()) if m else []
-        s = st.selectbox("Serienr.", serials, index=0 if serials else None, key="sel_serial")
+        q = st.text_input("Søg serienr.", key="serial_query", placeholder="Skriv serienr. eller en del af det")
+        if q:
+            hits = {" / ".join(str(v) for v in p): p for p in idx.search_serial(q)}
+            st.session_state.serial_hits = hits
+            st.selectbox(f"Fundet ({len(hits)})", list(hits), index=None, key="serial_hit",
+                         on_change=_apply_serial_hit)
+        t = st.selectbox("Type", types, index=_preset_index(types, pick[0]), key="sel_type")
+        brands = idx.options(t) if t else []
+        b = st.selectbox("Mærke", brands, index=_preset_index(brands, pick[1]), key="sel_brand")
+        models = idx.options(t, b) if b else []
+        m = st.selectbox("Model", models, index=_preset_index(models, pick[2]), key="sel_model")
+        serials = idx.options(t, b, m) if m else []
+        s = st.selectbox("Serienr.", serials, index=_preset_index(serials, pick[3]), key="sel_serial")
+        if m:
+            if st.session_state.get("sel_serials_model") != (t, b, m):
+                st.session_state.pop("sel_serials", None)  # picks from another model
+                st.session_state.sel_serials_model = (t, b, m)
+            st.multiselect("Flere serienr. af samme model (batch)", serials, key="sel_serials",
+                           placeholder="Vælg flere for at kontrollere dem på én gang")
     with c2:
         st.markdown("**Ny udstyr**")
         nt = st.text_input("Type", key="ne_type")
@@ -366,7 +426,10 @@ elif st.session_state.step == 3:
             if not nt or not nb or not nm or not ns:
                 st.error("Udfyld alle felter.")
             else:
-                upsert_equipment({"Type":nt,"Brand":nb,"Model":nm,"Serial":ns,"Notes":nn})
+                try:
+                    upsert_equipment({"Type":nt,"Brand":nb,"Model":nm,"Serial":ns,"Notes":nn})
+                except SheetsBusyError as e:
+                    _sheets_busy(e)
                 for k in ("sel_type", "sel_brand", "sel_model", "sel_serial"):
                     st.session_state.pop(k, None)
                 st.session_state.selection = {"Type":nt,"Brand":nb,"Model":nm,"Serial":ns}
@@ -377,46 +440,94 @@ elif st.session_state.step == 3:
     if c3.button("Tilbage"):
         st.session_state.step = 2
     if c4.button("Fortsæt"):
-        if not (st.session_state.get("sel_type") and st.session_state.get("sel_brand") and st.session_state.get("sel_model") and st.session_state.get("sel_serial")):
+        batch = st.session_state.get("sel_serials") or []
+        if batch and st.session_state.get("sel_model"):
+            st.session_state.selection = {"Type":st.session_state.sel_type,"Brand":st.session_state.sel_brand,"Model":st.session_state.sel_model,"Serials":[str(x) for x in batch]}
+            st.session_state.step = 4
+        elif not (st.session_state.get("sel_type") and st.session_state.get("sel_brand") and st.session_state.get("sel_model") and st.session_state.get("sel_serial")):
             st.warning("Vælg Type, Mærke, Model, Serienr.")
         else:
             st.session_state.selection = {"Type":st.session_state.sel_type,"Brand":st.session_state.sel_brand,"Model":st.session_state.sel_model,"Serial":st.session_state.sel_serial}
             st.session_state.step = 4
 
 # ---- Step 4: Checklist ----
+elif st.session_state.step == 4 and st.session_state.selection.get("Serials"):
+    _batch_checklist()
+
 elif st.session_state.step == 4:
     sel = st.session_state.selection
     st.subheader(f"Tjekliste — {sel['Type']} / {sel['Brand']} / {sel['Model']} / {sel['Serial']}")
-    tpl, rows = get_checklist(sel["Type"], sel["Brand"], sel["Model"])
+    key = (sel["Type"], sel["Brand"], sel["Model"], sel["Serial"])
+    pin = st.session_state.get("checklist")
+    if not pin or pin["key"] != key:
+        # resolved once per visit to the step; the widgets below never re-read the template
+        try:
+            tpl, rows = get_checklist(sel["Type"], sel["Brand"], sel["Model"])
+        except SheetsBusyError as e:
+            _sheets_busy(e)
+        pin = st.session_state.checklist = {"key": key, "tpl": tpl, "rows": rows, "saved": {}, "page": 0}
+    rows = pin["rows"]
     if not rows:
         st.error("Ingen tjekliste for denne kombination. Tilføj i Templates/TemplateItems.")
-        if st.button("Tilbage"): st.session_state.step = 3
+        if st.button("Tilbage"):
+            st.session_state.step = 3
+            st.session_state.pop("checklist", None)
     else:
-        # build checklist widgets
-        results = []
-        for i, r in enumerate(rows):
-            st.write(f"**{r['Item']}**  \n_{r.get('Instruction','')}_")
-            col1, col2, col3, col4 = st.columns([1,1,1,3])
-            status = col1.radio("Status", ["green","yellow","red"], horizontal=True, key=f"st_{i}")
-            note = col4.text_input("Note", key=f"nt_{i}")
-            results.append({"item": r["Item"], "instruction": r.get("Instruction",""), "status": status, "note": note})
-            st.divider()
-        
-        cal_to = st.text_input("Kalibreret til", placeholder="f.eks. 150Nm")
-        order_no = st.text_input("Ordre nr.", placeholder="f.eks. 1/11")
-
-        comment = st.text_area("Kommentar")
-        default_next = (datetime.today() + timedelta(days=365)).date()
-        next_date = st.date_input("Næste dato", value=default_next)
-
-                # --- actions ---
-   
-        c1, c2, c3 = st.columns(3)
+        # Everything is in one form, so answering items doesn't rerun the script; long
+        # checklists are split in pages of CHECKLIST_PAGE_SIZE (answers kept in pin["saved"])
+        saved = pin["saved"]
+        pages = -(-len(rows) // CHECKLIST_PAGE_SIZE)
+        page = min(pin["page"], pages - 1)
+        on_last = page == pages - 1
+        first, last = page * CHECKLIST_PAGE_SIZE, min(len(rows), (page + 1) * CHECKLIST_PAGE_SIZE)
+        page_keys = [k for i in range(first, last) for k in (f"st_{i}", f"nt_{i}")]
+        if on_last:
+            page_keys += ["cal_to", "order_no", "comment", "next_date"]
+        defaults = {"cal_to": "", "order_no": "", "comment": "",
+                    "next_date": (datetime.today() + timedelta(days=365)).date()}
+        for k in page_keys:
+            if k not in st.session_state:  # Streamlit drops widget state of pages not shown
+                st.session_state[k] = saved.get(k, defaults.get(k, "green" if k.startswith("st_") else ""))
+
+        with st.form("checklist_form"):
+            if pages > 1:
+                st.caption(f"Side {page + 1} af {pages} — punkt {first + 1}–{last} af {len(rows)}")
+            for i in range(first, last):
+                r = rows[i]
+                st.write(f"**{r['Item']}**  \n_{r.get('Instruction','')}_")
+                col1, col2, col3, col4 = st.columns([1,1,1,3])
+                col1.radio("Status", ["green","yellow","red"], horizontal=True, key=f"st_{i}")
+                col4.text_input("Note", key=f"nt_{i}")
+                st.divider()
+
+            if on_last:
+                cal_to = st.text_input("Kalibreret til", placeholder="f.eks. 150Nm", key="cal_to")
+                order_no = st.text_input("Ordre nr.", placeholder="f.eks. 1/11", key="order_no")
+                comment = st.text_area("Kommentar", key="comment")
+                next_date = st.date_input("Næste dato", key="next_date")
+
+            b1, b2, b3 = st.columns(3)
+            prev = pages > 1 and b1.form_submit_button("Forrige side", disabled=page == 0)
+            nxt = pages > 1 and b2.form_submit_button("Næste side", disabled=on_last)
+            confirm = b3.form_submit_button("Bekræft og generér rapport", disabled=not on_last)
+
+        if prev or nxt or confirm:
+            saved.update({k: st.session_state[k] for k in page_keys})
+        if prev or nxt:
+            pin["page"] = page + (1 if nxt else -1)
+            st.rerun()
+        results = [{"item": r["Item"], "instruction": r.get("Instruction",""),
+                    "status": saved.get(f"st_{i}", "green"), "note": saved.get(f"nt_{i}", "")}
+                   for i, r in enumerate(rows)]
+
+        # --- actions ---
+        c1, c3 = st.columns(2)
 
         if c1.button("Tilbage"):
             st.session_state.step = 3
+            st.session_state.pop("checklist", None)
 
-        if c2.button("Bekræft og generér rapport"):
+        if confirm:
             # --- 1) Timestamp & recipients from secrets ---
             ts = datetime.now().strftime("%Y-%m-%d %H:%M")
 
@@ -448,32 +559,25 @@ elif st.session_state.step == 4:
             }
 
             # --- 3) Generate PDF (always) ---
+            from report_pdf import gen_pdf, pdf_filename  # usually preloaded by _warm_up
             pdf_bytes = gen_pdf(report)
-            base_name = (
-                "Kalibrering"
-                if st.session_state.action.lower().startswith("kalibr")
-                else "Service"
-            )
-            pdf_name = (
-                f"{base_name}_{sel['Type']}_{sel['Brand']}_"
-                f"{sel['Model']}_{sel['Serial']}_"
-                f"{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
-            )
+            pdf_name = pdf_filename(report)
 
-            # Optional: still save a copy on disk (useful for local runs)
-            pdf_path = os.path.join(os.getcwd(), pdf_name)
+            # Keep it in the archive so it can be downloaded/re-sent from the history
             try:
-                with open(pdf_path, "wb") as f:
-                    f.write(pdf_bytes)
-                st.info(f"PDF gemt som: **{pdf_path}**")
+                key = archive_put(report, pdf_bytes)
+                pdf_path = archive_ref(key) if key else ""
+                if key:
+                    st.info(f"PDF arkiveret som: **{pdf_name}**")
             except Exception as e:
-                st.warning(f"Kunne ikke gemme PDF lokalt: {e}")
+                st.warning(f"Kunne ikke arkivere PDF: {e}")
                 pdf_path = ""  # avoid logging a wrong path
+            st.download_button("Hent PDF", pdf_bytes, file_name=pdf_name, mime="application/pdf")
 
             # --- 4) Send e-mail automatically (if recipients exist) ---
             if recipients:
                 try:
-                    send_email(
+                    queue_email(
                         recipients=recipients,
                         subject=(
                             f"Rapport: {st.session_state.action} — "
@@ -488,44 +592,19 @@ elif st.session_state.step == 4:
                         pdf_bytes=pdf_bytes,
                         filename=pdf_name,
                     )
-                    st.success("PDF sendt på e-mail.")
+                    st.success("PDF lagt i kø til afsendelse på e-mail.")
                 except Exception as e:
                     st.warning(f"E-mail kunne ikke sendes: {e}")
 
-            # --- 5) Log til Inspections + Logins (samme som før) ---
-            insp = read_sheet("Inspections")
-            row = {
-                "Timestamp": ts,
-                "User": st.session_state.user,
-                "Action": st.session_state.action,
-                "Type": sel["Type"],
-                "Brand": sel["Brand"],
-                "Model": sel["Model"],
-                "Serial": sel["Serial"],
-                "ResultsJSON": str(results),
-                "Comment": comment,
-                "NextDate": str(next_date),
-                "PdfPath": pdf_path,
-                "Recipients": ", ".join(recipients),
-            }
-            insp = pd.concat([insp, pd.DataFrame([row])], ignore_index=True)
-            write_sheet("Inspections", insp)
-
-            log = read_sheet("Logins")
-            log_row = {
-                "Timestamp": ts,
-                "User": st.session_state.user,
-                "Action": st.session_state.action,
-                "Equipment": (
-                    f"{sel['Type']}/{sel['Brand']}/{sel['Model']}/{sel['Serial']}"
-                ),
-                "NextDate": str(next_date),
-            }
-            log = pd.concat([log, pd.DataFrame([log_row])], ignore_index=True)
-            write_sheet("Logins", log)
+            # --- 5) Log til Inspections + Logins (journal; sent to the Sheet in the background) ---
+            journal_append("Inspections", [_inspection_row(report, pdf_path, recipients)])
+            journal_append("Logins", [_login_row(report)])
 
             st.session_state.results = results
+            st.session_state.pop("checklist", None)
             st.session_state.step = 5
 
         if c3.button("Close app"):
             st.stop()
+
+end_rerun()
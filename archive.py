@@ -0,0 +1,127 @@
+"""Content-addressed PDF archive.
+
+Each report PDF is stored once under the SHA-256 of the report content,
+gzip-compressed, in [app].archive_dir. Identical reports share one file.
+archive_dir must be durable storage (a mounted volume, not the app's own
+disk, which is wiped on every redeploy); without it nothing is archived and
+the history can only re-render from the log. Reading a PDF marks it as used; when the archive
+grows past [app].archive_max_mb (default 500) the least recently used files
+are removed until it is back under ARCHIVE_LOW_WATER of the limit.
+
+Inspections.PdfPath holds "archive:<key>", so a certificate can be
+downloaded or re-sent later without rendering it again.
+"""
+import gzip, hashlib, json, logging, os, re, threading
+import streamlit as st
+
+log = logging.getLogger(__name__)
+
+ARCHIVE_PREFIX = "archive:"
+ARCHIVE_LOW_WATER = 0.8
+
+def _archive_settings() -> dict:
+    cfg = st.secrets.get("app", {})
+    return {"dir": str(cfg.get("archive_dir", "") or ""),
+            "max_bytes": int(float(cfg.get("archive_max_mb", 500)) * 1024 * 1024)}
+
+@st.cache_resource
+def _archive_state():
+    return {"lock": threading.Lock(), "size": None, "warned": False}
+
+def report_key(report: dict) -> str:
+    """SHA-256 of the report content (key order and whitespace do not matter)."""
+    raw = json.dumps(report, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _path(cfg: dict, key: str) -> str:
+    return os.path.join(cfg["dir"], key[:2], key + ".pdf.gz")
+
+def _files(cfg: dict) -> list:
+    """(mtime, size, path) of every archived file."""
+    out = []
+    if not os.path.isdir(cfg["dir"]):
+        return out
+    for sub in os.scandir(cfg["dir"]):
+        if sub.is_dir():
+            for f in os.scandir(sub.path):
+                if f.name.endswith(".pdf.gz"):
+                    info = f.stat()
+                    out.append((info.st_mtime, info.st_size, f.path))
+    return out
+
+def _evict(cfg: dict, state: dict) -> None:
+    files = sorted(_files(cfg))
+    size = sum(s for _, s, _ in files)
+    target = cfg["max_bytes"] * ARCHIVE_LOW_WATER
+    for _, s, path in files:
+        if size <= target:
+            break
+        try:
+            os.remove(path)
+            size -= s
+        except FileNotFoundError:
+            pass
+    state["size"] = size
+
+def archive_put(report: dict, pdf_bytes: bytes):
+    """Store a rendered report and return its key (no-op if it is already archived);
+    None if no archive_dir is configured."""
+    cfg, state = _archive_settings(), _archive_state()
+    if not cfg["dir"]:
+        if not state["warned"]:
+            log.warning("[app].archive_dir is not set; PDFs are not archived")
+            state["warned"] = True
+        return None
+    key = report_key(report)
+    path = _path(cfg, key)
+    with state["lock"]:
+        if state["size"] is None:
+            state["size"] = sum(s for _, s, _ in _files(cfg))
+        if os.path.exists(path):
+            os.utime(path)
+            return key
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(gzip.compress(pdf_bytes, compresslevel=6, mtime=0))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        state["size"] += os.path.getsize(path)
+        if state["size"] > cfg["max_bytes"]:
+            _evict(cfg, state)
+    return key
+
+def archive_get(key: str):
+    """The archived PDF for `key`, or None if it was never stored, has been evicted
+    or cannot be read (the caller then renders it again)."""
+    key = key[len(ARCHIVE_PREFIX):] if key.startswith(ARCHIVE_PREFIX) else key
+    cfg = _archive_settings()
+    if not cfg["dir"] or not re.fullmatch(r"[0-9a-f]{64}", key):
+        return None  # the key comes from a sheet cell; never let it leave archive_dir
+    path = _path(cfg, key)
+    try:
+        with open(path, "rb") as f:
+            data = gzip.decompress(f.read())
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError) as e:  # damaged file (BadGzipFile is an OSError)
+        log.warning("archived PDF %s is unreadable: %s", key, e)
+        return None
+    if not data:
+        return None
+    try:
+        os.utime(path)  # recently used
+    except FileNotFoundError:
+        pass
+    return data
+
+def archive_ref(key: str) -> str:
+    """The PdfPath value for an archived report."""
+    return ARCHIVE_PREFIX + key
+
+def archive_stats() -> dict:
+    """Files and bytes in the archive, and the configured limit."""
+    cfg = _archive_settings()
+    files = _files(cfg) if cfg["dir"] else []
+    return {"files": len(files), "bytes": sum(s for _, s, _ in files), "max_bytes": cfg["max_bytes"]}
@@ -0,0 +1,487 @@
+"""Offline benchmarks for the storage, catalog, PDF and e-mail hot paths.
+
+The Google Sheet is replaced by an in-memory FakeSpreadsheet that counts API
+calls and payload bytes and can add a fixed latency per call; e-mail goes to
+a local SMTPSink. Each table size runs in a fresh process: the tabs are
+seeded with that many rows (same data every run), the app is driven through
+login -> select -> checklist -> submit with streamlit's AppTest, and then
+read_sheet, write_sheet, upsert_equipment, get_checklist and gen_pdf are
+timed on their own.
+
+    python bench.py                                   # 100, 1k, 10k, 100k rows
+    python bench.py --sizes 100,1000 --latency 0.2 --json before.json
+    python bench.py --compare before.json             # flag regressions
+    python bench.py --quota                           # scheduler vs. a fake quota
+
+Reported per step: wall seconds, Sheets API calls (by method), KB sent to and
+received from the API, and the process's peak RSS so far.
+"""
+import argparse, collections, json, multiprocessing, os, socketserver, sys, tempfile, threading, time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+BENCH_USER, BENCH_PASSWORD = "Bench User", "bench"
+
+
+# ----------------- Fake Sheets API -----------------
+def _trim(row) -> list:
+    # the Sheets API drops trailing empty cells (and empty trailing rows)
+    n = len(row)
+    while n and row[n - 1] == "":
+        n -= 1
+    return list(row[:n])
+
+class FakeWorksheet:
+    """The slice of gspread.Worksheet that storage.py uses."""
+
+    def __init__(self, spreadsheet, sheet_id: int, title: str, rows=None):
+        self.spreadsheet, self.id, self.title = spreadsheet, sheet_id, title
+        self.rows = [_trim([str(v) for v in r]) for r in rows or []]
+
+    def _compact(self) -> None:
+        while self.rows and not self.rows[-1]:
+            self.rows.pop()
+
+    def clear(self):
+        self.spreadsheet._call("values_clear", {"range": self.title})
+        self.rows = []
+
+    def update(self, values, range_name=None, **kwargs):
+        if range_name not in (None, "A1"):
+            raise NotImplementedError(f"FakeWorksheet.update at {range_name}")
+        self.spreadsheet._call("values_update", {"range": range_name, "values": values})
+        for i, row in enumerate(values):
+            new = _trim([str(v) for v in row])
+            if i < len(self.rows):
+                self.rows[i] = _trim(new + self.rows[i][len(new):])
+            else:
+                self.rows.append(new)
+
+    def row_values(self, row: int):
+        values = self.spreadsheet._call("values_get", {"range": f"{row}:{row}"},
+                                        {"values": [self.rows[row - 1]] if row <= len(self.rows) else []})
+        return values["values"][0] if values["values"] else []
+
+    def append_rows(self, values, value_input_option="RAW", table_range=None, **kwargs):
+        self.spreadsheet._call("values_append", {"values": values})
+        self._compact()
+        self.rows.extend(_trim([str(v) for v in row]) for row in values)
+
+
+def api_error(status: int, message: str = ""):
+    """A gspread APIError as the real client raises it for an HTTP error response."""
+    import requests
+    from gspread.exceptions import APIError
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = json.dumps({"error": {"code": status, "message": message or f"HTTP {status}",
+                                          "status": "RESOURCE_EXHAUSTED" if status == 429 else "UNAVAILABLE"}}).encode()
+    return APIError(resp)
+
+
+class FakeSpreadsheet:
+    """In-memory stand-in for gspread.Spreadsheet.
+
+    `calls` counts API round trips by method, `bytes_sent`/`bytes_received`
+    sum the JSON payloads, and every call sleeps `latency` seconds. With
+    `quota_per_min`, calls beyond that many per `quota_window` seconds are
+    refused with a 429 (counted in `rejected`), like the real per-user quota;
+    fail_next() makes the next calls fail with a given status.
+    """
+
+    def __init__(self, tabs: dict = None, latency: float = 0.0, quota_per_min: int = None,
+                 quota_window: float = 60.0, clock=time.monotonic):
+        self.id = "bench"
+        self.latency = latency
+        self.quota, self.quota_window, self.clock = quota_per_min, quota_window, clock
+        self.calls = collections.Counter()
+        self.bytes_sent = self.bytes_received = 0
+        self.rejected = 0
+        self._recent = collections.deque()  # call times inside the quota window
+        self._failures = collections.deque()
+        self._lock = threading.Lock()
+        self._sheets = {}
+        for name, rows in (tabs or {}).items():
+            self._sheets[name] = FakeWorksheet(self, len(self._sheets) + 1, name, rows)
+
+    def add_worksheet(self, title: str, rows: int = 1000, cols: int = 26, index=None) -> FakeWorksheet:
+        self._call("add_sheet", {"title": title, "rows": rows, "cols": cols})
+        with self._lock:
+            if title in self._sheets:
+                raise api_error(400, f'A sheet with the name "{title}" already exists.')
+            ws = self._sheets[title] = FakeWorksheet(self, len(self._sheets) + 1, title)
+        return ws
+
+    def fail_next(self, status: int, times: int = 1) -> None:
+        self._failures.extend([status] * times)
+
+    def _admit(self) -> None:
+        with self._lock:
+            if self._failures:
+                raise api_error(self._failures.popleft())
+            if self.quota is None:
+                return
+            now = self.clock()
+            while self._recent and now - self._recent[0] >= self.quota_window:
+                self._recent.popleft()
+            if len(self._recent) >= self.quota:
+                self.rejected += 1
+                raise api_error(429, "Quota exceeded for quota metric 'Read requests'")
+            self._recent.append(now)
+
+    def _call(self, method: str, request, response=None):
+        self._admit()
+        sent = json.dumps(request, ensure_ascii=False)
+        received = json.dumps(response if response is not None else {}, ensure_ascii=False)
+        with self._lock:
+            self.calls[method] += 1
+            self.bytes_sent += len(sent.encode("utf-8"))
+            self.bytes_received += len(received.encode("utf-8"))
+        if self.latency:
+            time.sleep(self.latency)
+        return json.loads(received)  # callers get a decoded copy, as over the wire
+
+    def snapshot(self) -> tuple:
+        with self._lock:
+            return sum(self.calls.values()), collections.Counter(self.calls), self.bytes_sent, self.bytes_received
+
+    def worksheet(self, title: str) -> FakeWorksheet:
+        self._call("fetch_sheet_metadata", {"title": title})
+        if title not in self._sheets:
+            from gspread.exceptions import WorksheetNotFound
+            raise WorksheetNotFound(title)
+        return self._sheets[title]
+
+    def values_batch_get(self, ranges, params=None):
+        value_ranges = []
+        for r in ranges:
+            if r.strip("'") not in self._sheets:
+                self._call("values_batch_get", {"ranges": list(ranges)})
+                raise api_error(400, f"Unable to parse range: {r}")
+            ws = self._sheets[r.strip("'")]
+            ws._compact()
+            value_ranges.append({"range": r, "majorDimension": "ROWS", "values": ws.rows})
+        return self._call("values_batch_get", {"ranges": list(ranges)},
+                          {"spreadsheetId": self.id, "valueRanges": value_ranges})
+
+    def batch_update(self, body):
+        reply = self._call("batch_update", body, {"spreadsheetId": self.id, "replies": [{}] * len(body["requests"])})
+        by_id = {ws.id: ws for ws in self._sheets.values()}
+        for req in body["requests"]:
+            if "updateCells" in req:
+                u = req["updateCells"]
+                rng = u["range"]
+                ws = by_id[rng["sheetId"]]
+                c0 = rng.get("startColumnIndex", 0)
+                c1 = rng.get("endColumnIndex", c0 + max((len(r.get("values", [])) for r in u.get("rows", [])), default=0))
+                for i, r in enumerate(range(rng["startRowIndex"], rng["endRowIndex"])):
+                    cells = u["rows"][i]["values"] if "rows" in u else [{}] * (c1 - c0)
+                    while len(ws.rows) <= r:
+                        ws.rows.append([])
+                    row = ws.rows[r] + [""] * max(0, c1 - len(ws.rows[r]))
+                    row[c0:c1] = [c.get("userEnteredValue", {}).get("stringValue", "") for c in cells]
+                    ws.rows[r] = _trim(row)
+            elif "appendCells" in req:
+                a = req["appendCells"]
+                ws = by_id[a["sheetId"]]
+                ws._compact()
+                ws.rows.extend(_trim([c.get("userEnteredValue", {}).get("stringValue", "") for c in r["values"]])
+                               for r in a["rows"])
+            else:
+                raise NotImplementedError(f"FakeSpreadsheet.batch_update: {list(req)}")
+        return reply
+
+
+# ----------------- SMTP sink -----------------
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        sink = self.server.sink
+        self.wfile.write(b"220 bench ESMTP\r\n")
+        data = None
+        for line in self.rfile:
+            if data is not None:
+                if line.rstrip(b"\r\n") == b".":
+                    with sink.lock:
+                        sink.messages.append(b"".join(data))
+                    data = None
+                    self.wfile.write(b"250 OK\r\n")
+                else:
+                    data.append(line)
+                continue
+            cmd = line[:4].upper()
+            if cmd == b"DATA":
+                data = []
+                self.wfile.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+            elif cmd == b"QUIT":
+                self.wfile.write(b"221 Bye\r\n")
+                return
+            else:  # EHLO/HELO/MAIL/RCPT/NOOP/RSET
+                self.wfile.write(b"250 OK\r\n")
+
+class SMTPSink:
+    """A local SMTP server that accepts everything and keeps the raw messages."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.messages, self.lock = [], threading.Lock()
+        self.server = socketserver.ThreadingTCPServer((host, port), _SMTPHandler)
+        self.server.daemon_threads = True
+        self.server.sink = self
+        self.host, self.port = self.server.server_address
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# ----------------- Seed data -----------------
+def seed_tabs(n: int) -> dict:
+    """Raw tab values (header first) with `n` rows in every growing tab; deterministic."""
+    import bcrypt
+    from storage import DB_SHEETS
+    from history import results_to_json
+    pw_hash = bcrypt.hashpw(BENCH_PASSWORD.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+    path = lambda i: (f"T{i % 20}", f"B{i // 20 % 10}", f"M{i // 200 % 10}")
+    equipment = [[*path(i), f"SN{i:06d}", ""] for i in range(n)]
+    combos = sorted({tuple(r[:3]) for r in equipment})
+    templates = [[f"TPL{j}", *c] for j, c in enumerate(combos)]
+    items = [[f"TPL{j}", f"Punkt {k}", f"Kontroller punkt {k}"] for j in range(len(combos)) for k in range(6)]
+    results = results_to_json([{"item": f"Punkt {k}", "instruction": "", "status": "green", "note": ""}
+                               for k in range(6)])
+    inspections, logins = [], []
+    for i in range(n):
+        ts = f"{2022 + i % 3}-{i % 12 + 1:02d}-{i % 28 + 1:02d} {i % 24:02d}:{i % 60:02d}"
+        nxt = f"{2023 + i % 3}-{i % 12 + 1:02d}-{i % 28 + 1:02d}"
+        t, b, m = path(i)
+        inspections.append([ts, f"User {i % 50}", "Kalibrering", t, b, m, f"SN{i:06d}", results, "", nxt, "", ""])
+        logins.append([ts, f"User {i % 50}", "Kalibrering", f"{t}/{b}/{m}/SN{i:06d}", nxt])
+    users = [[f"User {i}", pw_hash, "", "TRUE"] for i in range(max(n - 1, 0))] + [[BENCH_USER, pw_hash, "", "TRUE"]]
+    data = {"Users": users, "Equipment": equipment, "Templates": templates, "TemplateItems": items,
+            "Inspections": inspections, "Logins": logins}
+    return {name: [DB_SHEETS[name]] + data[name] for name in DB_SHEETS}
+
+
+# ----------------- Runner -----------------
+def _write_secrets(workdir: str, smtp_port: int) -> None:
+    os.makedirs(os.path.join(workdir, ".streamlit"), exist_ok=True)
+    with open(os.path.join(workdir, ".streamlit", "secrets.toml"), "w", encoding="utf-8") as f:
+        f.write(f"""[app]
+backend = "sheets"
+spreadsheet_id = "bench"
+archive_dir = "{os.path.join(workdir, 'pdf_archive')}"
+journal_delay = 3600
+default_recipients = ["bench@example.com"]
+
+[smtp]
+host = "127.0.0.1"
+port = {smtp_port}
+starttls = false
+user = ""
+sender_email = "kma@example.com"
+merge_window = 0
+""")
+
+def _peak_rss_mb() -> float:
+    if resource is None:
+        return 0.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _click(at, label: str):
+    # the app sets the next step without st.rerun(), so it shows up one rerun later
+    next(b for b in at.button if b.label == label).click()
+    return at.run().run()
+
+def run_size(n: int, latency: float = 0.0) -> list:
+    """Seed `n` rows, run the flow and the single-function timings. Returns one record per step."""
+    workdir = tempfile.mkdtemp(prefix="kma-bench-")
+    sink = SMTPSink()
+    _write_secrets(workdir, sink.port)
+    os.chdir(workdir)  # secrets, outbox and saved PDFs live here
+
+    import storage
+    fake = FakeSpreadsheet(seed_tabs(n), latency)
+    storage._gsheet_client = lambda: fake
+
+    from streamlit.testing.v1 import AppTest
+    from catalog import upsert_equipment, get_checklist
+    from report_pdf import gen_pdf
+
+    records = []
+    def measure(step: str, fn):
+        calls0, by0, sent0, recv0 = fake.snapshot()
+        t0 = time.perf_counter()
+        out = fn()
+        secs = time.perf_counter() - t0
+        calls1, by1, sent1, recv1 = fake.snapshot()
+        records.append({"rows": n, "step": step, "seconds": round(secs, 4), "api_calls": calls1 - calls0,
+                        "calls_by_method": dict(by1 - by0), "kb_sent": round((sent1 - sent0) / 1024, 1),
+                        "kb_received": round((recv1 - recv0) / 1024, 1), "peak_rss_mb": round(_peak_rss_mb(), 1)})
+        return out
+
+    # login -> select -> checklist -> submit
+    at = AppTest.from_file(os.path.join(HERE, "app.py"), default_timeout=600)
+    measure("flow: open app", at.run)
+    at.text_input[0].input(BENCH_USER)
+    at.text_input[1].input(BENCH_PASSWORD)
+    measure("flow: login", lambda: _click(at, "Login"))
+    measure("flow: choose action", lambda: _click(at, "Kalibrering"))
+    measure("flow: select equipment", lambda: _click(at, "Fortsæt"))
+    measure("flow: submit checklist", lambda: _click(at, "Bekræft og generér rapport"))
+    if at.exception:
+        raise RuntimeError(f"app raised during the flow: {at.exception[0].message}")
+    # the submit only journals its rows (journal_delay keeps the flusher from
+    # racing us); this is where its Sheets writes are paid
+    from journal import journal_flusher
+    measure("flow: journal flush", lambda: journal_flusher().flush_once(force=True))
+
+    def delivered():
+        deadline = time.monotonic() + 60
+        while not sink.messages and time.monotonic() < deadline:
+            time.sleep(0.01)
+        if not sink.messages:
+            raise RuntimeError("the queued e-mail never reached the SMTP sink")
+    measure("flow: e-mail delivered", delivered)
+
+    # single functions
+    measure("read_sheet Equipment (cold)", lambda: (storage.invalidate_sheet("Equipment"),
+                                                    storage.read_sheet("Equipment")))
+    measure("read_sheet Equipment (warm)", lambda: storage.read_sheet("Equipment"))
+    df = storage.read_sheet("Equipment")
+    df.loc[len(df) // 2, "Notes"] = "bench"
+    measure("write_sheet Equipment (1 cell)", lambda: storage.write_sheet("Equipment", df))
+    measure("upsert_equipment (new)", lambda: upsert_equipment(
+        {"Type": "T0", "Brand": "B0", "Model": "M0", "Serial": "SN-NEW", "Notes": ""}))
+    measure("upsert_equipment journal flush", lambda: journal_flusher().flush_once(force=True))
+    measure("get_checklist (cold)", lambda: (storage.invalidate_sheet("Templates"),
+                                             get_checklist("T0", "B0", "M0")))
+    measure("get_checklist (warm)", lambda: get_checklist("T0", "B0", "M0"))
+    report = {"Timestamp": "2024-01-01 12:00", "User": BENCH_USER, "Action": "Kalibrering",
+              "Type": "T0", "Brand": "B0", "Model": "M0", "Serial": "SN000000", "Comment": "",
+              "NextDate": "2025-01-01", "CalibratedTo": "", "OrderNo": "",
+              "Results": [{"item": f"Punkt {k}", "status": "green", "note": ""} for k in range(6)]}
+    measure("gen_pdf", lambda: gen_pdf(report))
+
+    sink.close()
+    return records
+
+
+def run(sizes, latency: float = 0.0) -> list:
+    """run_size for every size, each in a fresh interpreter so caches and peak RSS start clean."""
+    records = []
+    ctx = multiprocessing.get_context("spawn")
+    for n in sizes:
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+            records.extend(pool.submit(run_size, n, latency).result())
+    return records
+
+
+def compare(records: list, baseline: list, threshold: float = 0.25) -> list:
+    """Steps that got slower than `threshold` (relative) or now make more API calls or move more bytes."""
+    base = {(r["rows"], r["step"]): r for r in baseline}
+    worse = []
+    for r in records:
+        b = base.get((r["rows"], r["step"]))
+        if b is None:
+            continue
+        slower = r["seconds"] > b["seconds"] * (1 + threshold) and r["seconds"] - b["seconds"] > 0.01
+        kb, base_kb = r["kb_sent"] + r["kb_received"], b["kb_sent"] + b["kb_received"]
+        if slower or r["api_calls"] > b["api_calls"] or kb > base_kb * (1 + threshold) + 1:
+            worse.append({"rows": r["rows"], "step": r["step"], "seconds": r["seconds"], "base_seconds": b["seconds"],
+                          "api_calls": r["api_calls"], "base_api_calls": b["api_calls"],
+                          "kb": round(kb, 1), "base_kb": round(base_kb, 1)})
+    return worse
+
+
+# ----------------- Quota -----------------
+class FakeClock:
+    """Simulated time shared by the scheduler and the fake: sleep() just moves it forward."""
+
+    def __init__(self):
+        self.t = 0.0
+        self.lock = threading.Lock()
+
+    def __call__(self) -> float:
+        return self.t
+
+    def sleep(self, seconds: float) -> None:
+        with self.lock:
+            self.t += max(seconds, 0.0)
+
+def quota_check(per_minute: int = 60, calls: int = 600, sessions: int = 12) -> dict:
+    """The scheduler against a fake that refuses calls over `per_minute`.
+
+    `calls` reads go through a SheetsScheduler on simulated time: none may be
+    refused and they must take about as long as the quota allows. Then
+    `sessions` threads read the same tab at once (real time, 0.2 s latency)
+    and must share a single API call.
+    """
+    from scheduler import SheetsScheduler
+    tabs = seed_tabs(10)
+    clock = FakeClock()
+    fake = FakeSpreadsheet(tabs, quota_per_min=per_minute, clock=clock)
+    sch = SheetsScheduler(per_minute, clock=clock, sleep=clock.sleep, rng=lambda: 0.5)
+    for _ in range(calls):
+        sch.call(lambda: fake.values_batch_get(["'Users'"]))
+    burst = max(1.0, per_minute / 4)
+    expected = (calls - burst) / ((per_minute - burst) / 60.0)
+
+    fake2 = FakeSpreadsheet(tabs, latency=0.2)
+    sch2 = SheetsScheduler(per_minute)
+    start = threading.Barrier(sessions)
+    def session():
+        start.wait()
+        sch2.call(lambda: fake2.values_batch_get(["'Users'"]), key=("values_batch_get", ("Users",)))
+    threads = [threading.Thread(target=session) for _ in range(sessions)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    out = {"calls": calls, "per_minute": per_minute, "simulated_sec": round(clock(), 1),
+           "expected_sec": round(expected, 1), "rejected": fake.rejected, "retries": sch.stats["retries"],
+           "failed": sch.stats["failed"], "sessions": sessions,
+           "session_api_calls": fake2.calls["values_batch_get"]}
+    out["ok"] = (out["rejected"] == 0 and out["failed"] == 0 and out["session_api_calls"] == 1
+                 and abs(clock() - expected) <= 1.0)
+    return out
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, HERE)
+    ap = argparse.ArgumentParser(description="Offline benchmarks against a fake Sheet and SMTP sink.")
+    ap.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="comma-separated row counts")
+    ap.add_argument("--latency", type=float, default=0.0, help="seconds added to every Sheets API call")
+    ap.add_argument("--json", help="write the results to this file")
+    ap.add_argument("--compare", help="baseline JSON from an earlier --json run; exit 1 on regressions")
+    ap.add_argument("--threshold", type=float, default=0.25, help="allowed relative slowdown (default 0.25)")
+    ap.add_argument("--quota", action="store_true",
+                    help="only check the Sheets scheduler against a fake quota (simulated time); exit 1 on failure")
+    args = ap.parse_args()
+
+    if args.quota:
+        result = quota_check()
+        print(json.dumps(result))
+        sys.exit(0 if result["ok"] else 1)
+
+    import pandas as pd
+    records = run([int(s) for s in args.sizes.split(",")], args.latency)
+    table = pd.DataFrame(records).drop(columns=["calls_by_method"])
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(table.to_string(index=False))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"latency": args.latency, "records": records}, f, indent=1)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            worse = compare(records, json.load(f)["records"], args.threshold)
+        if worse:
+            print("\nRegressions against", args.compare)
+            print(pd.DataFrame(worse).to_string(index=False))
+            sys.exit(1)
+        print("\nNo regressions against", args.compare)
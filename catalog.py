@@ -0,0 +1,169 @@
+"""Equipment catalog and checklist lookups used by steps 3 and 4.
+
+The Type -> Brand -> Model -> Serial cascade and the checklist templates are
+served from indexes built once per data version (storage.sheet_version)
+instead of re-filtering whole tabs on every rerun.
+"""
+import bisect, threading
+import streamlit as st
+import pandas as pd
+from storage import read_sheet, read_sheets, sheet_version, sheet_versions, norm
+from journal import journal_upsert
+
+LEVELS = ["Type", "Brand", "Model", "Serial"]
+
+def _sort_key(v):
+    return str(v)
+
+def _blank(v) -> bool:
+    return v is None or v != v  # None / NaN
+
+def _path(values) -> tuple:
+    # Sheets cells come back numericised (730) while written records are strings ("730");
+    # the index holds everything as str so both land on the same key
+    return tuple(str(v) for v in values)
+
+def _serial_entry(path):
+    return (norm(path[3]), path, path)
+
+def _serial_key(entry):
+    return entry[:2]
+
+
+class EquipmentIndex:
+    """Pre-sorted Type -> Brand -> Model -> Serial hierarchy.
+
+    `children` maps a path prefix tuple, e.g. () or ("Momentnøgle", "Stahlwille"),
+    to the sorted list of values at the next level, so every dropdown is one
+    dict lookup. `serials` is a sorted list of (normalized serial, path as
+    strings, path) for type-ahead search across the whole fleet. All values
+    are strings, whatever type the cells had.
+    """
+
+    def __init__(self, df: pd.DataFrame, version: int = 0):
+        self.version = version
+        self.children = {}
+        self.serials = []
+        paths = df[LEVELS].itertuples(index=False, name=None)
+        for path in set(_path(p) for p in paths if not any(_blank(v) for v in p)):
+            for depth in range(len(LEVELS)):
+                self.children.setdefault(path[:depth], set()).add(path[depth])
+            self.serials.append(_serial_entry(path))
+        self.children = {k: sorted(v, key=_sort_key) for k, v in self.children.items()}
+        self.serials.sort(key=_serial_key)
+
+    def options(self, *prefix) -> list:
+        """Values for the level below `prefix` (e.g. options(t, b) -> models)."""
+        return self.children.get(tuple(prefix), [])
+
+    def add(self, rec) -> None:
+        """Insert one equipment record (incremental update after an upsert)."""
+        path = tuple(rec.get(c) for c in LEVELS)
+        if any(_blank(v) for v in path):
+            return
+        path = _path(path)
+        for depth in range(len(LEVELS)):
+            values = self.children.setdefault(path[:depth], [])
+            i = bisect.bisect_left(values, _sort_key(path[depth]), key=_sort_key)
+            if i < len(values) and _sort_key(values[i]) == _sort_key(path[depth]):
+                continue
+            values.insert(i, path[depth])
+        entry = _serial_entry(path)
+        i = bisect.bisect_left(self.serials, _serial_key(entry), key=_serial_key)
+        if i == len(self.serials) or _serial_key(self.serials[i]) != _serial_key(entry):
+            self.serials.insert(i, entry)
+
+    def search_serial(self, query: str, limit: int = 50) -> list:
+        """Paths whose serial starts with (then contains) `query`, case-insensitive."""
+        q = norm(query)
+        if not q:
+            return []
+        out = []
+        i = bisect.bisect_left(self.serials, (q,), key=_serial_key)
+        while i < len(self.serials) and len(out) < limit and self.serials[i][0].startswith(q):
+            out.append(self.serials[i][2])
+            i += 1
+        if len(out) < limit:
+            seen = set(out)
+            for s, _, path in self.serials:
+                if q in s and path not in seen:
+                    out.append(path)
+                    if len(out) >= limit:
+                        break
+        return out
+
+
+@st.cache_resource
+def _equipment_holder():
+    return {"lock": threading.Lock(), "index": None}
+
+def equipment_index() -> EquipmentIndex:
+    """The shared EquipmentIndex, rebuilt only when the Equipment tab changes."""
+    holder = _equipment_holder()
+    version = sheet_version("Equipment")
+    with holder["lock"]:
+        idx = holder["index"]
+        if idx is None or idx.version != version:
+            idx = holder["index"] = EquipmentIndex(read_sheet("Equipment"), version)
+        return idx
+
+def upsert_equipment(rec):
+    # Match on Type/Brand/Model/Serial (case/space insensitive); update notes only
+    # on a hit so there is never a duplicate row
+    holder = _equipment_holder()
+    with holder["lock"]:
+        before = sheet_version("Equipment")
+        inserted = journal_upsert("Equipment", rec, ["Notes"])
+        idx = holder["index"]
+        if idx is not None and idx.version == before:
+            # keep the index in step with the write instead of rebuilding it
+            if inserted:
+                idx.add(rec)
+            idx.version = sheet_version("Equipment")
+    return inserted
+
+
+# A Brand or Model of "*" in Templates matches any value, e.g. one checklist
+# for every model of a brand: Template=T1, Type=Momentnøgle, Brand=Stahlwille, Model=*
+WILDCARD = "*"
+
+class TemplateIndex:
+    """Normalized (type, brand, model) -> (template, ordered checklist items)."""
+
+    def __init__(self, tpls: pd.DataFrame, items: pd.DataFrame, version=None):
+        self.version = version
+        by_tpl = {}
+        for tpl, item, instr in items[["Template","Item","Instruction"]].itertuples(index=False, name=None):
+            by_tpl.setdefault(norm(tpl), []).append({"Item": item, "Instruction": instr})
+        self.checklists = {}
+        for tpl, t, b, m in tpls[["Template","Type","Brand","Model"]].itertuples(index=False, name=None):
+            # first matching row wins, as with the old hit.iloc[0]
+            self.checklists.setdefault((norm(t), norm(b), norm(m)), (tpl, by_tpl.get(norm(tpl), [])))
+
+    def resolve(self, t, b, m):
+        """Most specific template for the equipment: exact, then brand-wide, then type-wide."""
+        t, b, m = norm(t), norm(b), norm(m)
+        for key in ((t, b, m), (t, b, WILDCARD), (t, WILDCARD, WILDCARD), (WILDCARD, WILDCARD, WILDCARD)):
+            hit = self.checklists.get(key)
+            if hit:
+                return hit[0], [dict(r) for r in hit[1]]
+        return None, []
+
+
+@st.cache_resource
+def _template_holder():
+    return {"lock": threading.Lock(), "index": None}
+
+def template_index() -> TemplateIndex:
+    """The shared TemplateIndex, rebuilt only when Templates or TemplateItems change."""
+    holder = _template_holder()
+    version = tuple(sheet_versions(["Templates", "TemplateItems"]).values())
+    with holder["lock"]:
+        idx = holder["index"]
+        if idx is None or idx.version != version:
+            tabs = read_sheets(["Templates", "TemplateItems"])
+            idx = holder["index"] = TemplateIndex(tabs["Templates"], tabs["TemplateItems"], version)
+        return idx
+
+def get_checklist(t, b, m):
+    return template_index().resolve(t, b, m)
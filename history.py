@@ -0,0 +1,240 @@
+"""Inspection history.
+
+ResultsJSON holds the checklist results as compact JSON (older rows hold a
+Python repr; parse_results reads both and `python history.py migrate`
+rewrites them).
+
+inspections() and inspection_items() load the Inspections tab once per data
+version into columnar frames: parsed timestamps, and one row per checklist
+item. Queries on top of them are plain vectorized pandas, e.g.
+
+    since = pd.Timestamp.now() - pd.DateOffset(years=1)
+    query_items(status="red", model="730", since=since)
+    fail_rates(by=["Model", "Item"], since=since)
+
+due_status() classifies every piece of equipment by the NextDate of its
+latest inspection (overdue / due / ok). The app shows it on step 2; for a
+daily e-mail, run from cron:
+
+    python history.py digest --days 30
+"""
+import argparse, ast, json, threading
+import numpy as np
+import streamlit as st
+import pandas as pd
+from storage import read_sheet, write_sheet, sheet_version, sser, norm
+
+def results_to_json(results) -> str:
+    """Checklist results -> compact JSON for the ResultsJSON column."""
+    return json.dumps(results, ensure_ascii=False, separators=(",", ":"))
+
+def parse_results(raw) -> list:
+    """ResultsJSON cell -> list of result dicts (JSON, or the legacy Python repr)."""
+    if isinstance(raw, list):
+        return raw
+    raw = str(raw or "").strip()
+    if not raw:
+        return []
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return ast.literal_eval(raw)
+
+def _safe_parse(raw) -> list:
+    try:
+        res = parse_results(raw)
+    except (ValueError, SyntaxError):
+        return []
+    return res if isinstance(res, list) else []
+
+
+# ----------------- Columnar history -----------------
+EQUIPMENT_KEY = ["Type","Brand","Model","Serial"]
+
+def build_history(df: pd.DataFrame, offset: int = 0):
+    """Inspections rows -> (inspections frame, exploded items frame).
+
+    Items carry the inspection's row number in `InspectionId` plus the
+    Timestamp/User/Action/Type/Brand/Model/Serial columns, so filters need no join.
+    `offset` is the row number of df's first row (for incremental builds).
+    """
+    insp = df.drop(columns=["ResultsJSON"]).reset_index(drop=True)
+    insp.index = insp.index + offset
+    insp["Timestamp"] = pd.to_datetime(insp["Timestamp"], errors="coerce")
+    insp["NextDate"] = pd.to_datetime(insp["NextDate"], errors="coerce")
+    insp.index.name = "InspectionId"
+
+    parsed = [_safe_parse(x) for x in df["ResultsJSON"]]
+    lengths = np.fromiter((len(p) for p in parsed), dtype=np.int64, count=len(parsed))
+    flat = [r if isinstance(r, dict) else {} for p in parsed for r in p]
+    items = pd.DataFrame({
+        "Item":        [r.get("item", "") for r in flat],
+        "Instruction": [r.get("instruction", "") for r in flat],
+        "Status":      [str(r.get("status") or "").lower() for r in flat],
+        "Note":        [r.get("note", "") for r in flat],
+    })
+    owner = np.repeat(np.arange(len(insp)), lengths)
+    meta = insp[["Timestamp","User","Action","Type","Brand","Model","Serial"]].iloc[owner].reset_index()
+    items = pd.concat([meta, items], axis=1)
+    return insp, items
+
+def latest_per_equipment(insp: pd.DataFrame) -> pd.DataFrame:
+    """Most recent inspection per (Type, Brand, Model, Serial), case/space insensitive."""
+    keyed = insp.assign(**{f"_{c}": sser(insp[c]) for c in EQUIPMENT_KEY})
+    keyed = keyed.sort_values("Timestamp", kind="stable", na_position="first")
+    return keyed.drop_duplicates([f"_{c}" for c in EQUIPMENT_KEY], keep="last")
+
+@st.cache_resource
+def _history_holder():
+    return {"lock": threading.Lock(), "version": None, "rows": 0, "last_row": None,
+            "frames": None, "latest": None}
+
+def _history():
+    """(inspections, items, latest) for the current Inspections version.
+
+    When the tab only grew (new inspections appended), just the new rows are
+    parsed and folded in; anything else triggers a full rebuild.
+    """
+    holder = _history_holder()
+    version = sheet_version("Inspections")
+    with holder["lock"]:
+        if holder["version"] != version:
+            df = read_sheet("Inspections")
+            n = holder["rows"]
+            if (holder["frames"] is not None and 0 < n < len(df)
+                    and df.iloc[n - 1].astype(str).equals(holder["last_row"])):
+                insp_new, items_new = build_history(df.iloc[n:], offset=n)
+                insp, items = holder["frames"]
+                holder["frames"] = (pd.concat([insp, insp_new]), pd.concat([items, items_new], ignore_index=True))
+                holder["latest"] = latest_per_equipment(pd.concat([holder["latest"], insp_new]))
+            else:
+                holder["frames"] = build_history(df)
+                holder["latest"] = latest_per_equipment(holder["frames"][0])
+            holder["rows"] = len(df)
+            holder["last_row"] = df.iloc[-1].astype(str) if len(df) else None
+            holder["version"] = version
+        return holder["frames"] + (holder["latest"],)
+
+def inspections() -> pd.DataFrame:
+    """One row per inspection, Timestamp/NextDate as datetimes (no ResultsJSON)."""
+    return _history()[0]
+
+def inspection_items() -> pd.DataFrame:
+    """One row per checklist item of every inspection."""
+    return _history()[1]
+
+
+def _filter(df: pd.DataFrame, since=None, until=None, **eq) -> pd.DataFrame:
+    mask = pd.Series(True, index=df.index)
+    if since is not None:
+        mask &= df["Timestamp"] >= pd.Timestamp(since)
+    if until is not None:
+        mask &= df["Timestamp"] <= pd.Timestamp(until)
+    for col, value in eq.items():
+        if value is not None:
+            mask &= sser(df[col]) == norm(value)
+    return df[mask]
+
+def query_items(status=None, type=None, brand=None, model=None, serial=None, item=None,
+                since=None, until=None) -> pd.DataFrame:
+    """Checklist items matching the filters (case/space insensitive; None = any)."""
+    return _filter(inspection_items(), since, until, Status=status, Type=type, Brand=brand,
+                   Model=model, Serial=serial, Item=item)
+
+def fail_rates(by=("Item",), since=None, until=None, **filters) -> pd.DataFrame:
+    """Checks, red/yellow counts and FailRate (red share) grouped by `by`."""
+    by = list(by)
+    items = query_items(since=since, until=until, **filters)
+    flags = items[by].assign(Checks=1, Red=items["Status"].eq("red").astype(int),
+                             Yellow=items["Status"].eq("yellow").astype(int))
+    out = flags.groupby(by, sort=False).sum()
+    out["FailRate"] = out["Red"] / out["Checks"]
+    return out.sort_values(["FailRate", "Checks"], ascending=False).reset_index()
+
+
+# ----------------- Due dates -----------------
+DUE_DAYS = 30  # "due soon" window; override with [app].due_days
+
+def classify_due(latest: pd.DataFrame, days: int = DUE_DAYS, today=None) -> pd.DataFrame:
+    """Status per equipment from its latest inspection's NextDate.
+
+    Status is "overdue" (NextDate passed), "due" (within `days`), "ok", or
+    "unknown" (no readable NextDate). Sorted most urgent first.
+    """
+    today = pd.Timestamp(today or pd.Timestamp.now()).normalize()
+    out = latest[EQUIPMENT_KEY + ["Timestamp", "User", "Action", "NextDate"]].rename(
+        columns={"Timestamp": "LastInspection", "User": "LastUser", "Action": "LastAction"})
+    days_left = (out["NextDate"] - today).dt.days.astype("Int64")
+    conds = [days_left.isna(), days_left < 0, days_left <= days]
+    out["DaysLeft"] = days_left
+    out["Status"] = np.select([c.fillna(False).to_numpy(bool) for c in conds], ["unknown", "overdue", "due"], "ok")
+    return out.sort_values("DaysLeft", na_position="last").reset_index(drop=True)
+
+def due_status(days: int = None, today=None) -> pd.DataFrame:
+    """classify_due over the whole log; `latest` is kept up to date incrementally."""
+    if days is None:
+        days = int(st.secrets.get("app", {}).get("due_days", DUE_DAYS))
+    return classify_due(_history()[2], days, today)
+
+def due_digest(days: int = None, today=None) -> str:
+    """Plain-text digest of overdue and soon-due equipment, for e-mail."""
+    df = due_status(days, today)
+    lines = []
+    for status, title in (("overdue", "Overskredet"), ("due", "Forfalder snart")):
+        part = df[df["Status"] == status]
+        lines.append(f"{title} ({len(part)}):")
+        for r in part.itertuples(index=False):
+            lines.append(f"  {r.Type} / {r.Brand} / {r.Model} / {r.Serial}  "
+                         f"næste: {r.NextDate:%Y-%m-%d} ({r.DaysLeft:+d} dage)")
+        lines.append("")
+    return "\n".join(lines)
+
+
+# ----------------- Migration -----------------
+def _to_json_cell(x: str) -> str:
+    if not x.strip():
+        return x
+    try:
+        json.loads(x)
+        return x  # already JSON
+    except ValueError:
+        pass
+    try:
+        return results_to_json(ast.literal_eval(x))
+    except (ValueError, SyntaxError):
+        return x  # leave unreadable cells alone
+
+def migrate_results_json(dry_run: bool = False) -> int:
+    """Rewrite legacy (Python repr) ResultsJSON cells as JSON. Returns rows changed."""
+    df = read_sheet("Inspections")
+    raw = df["ResultsJSON"].fillna("").astype(str)
+    converted = raw.map(_to_json_cell)
+    changed = converted != raw
+    if changed.any() and not dry_run:
+        df.loc[changed, "ResultsJSON"] = converted[changed]
+        write_sheet("Inspections", df)  # diff write: only the changed cells are sent
+    return int(changed.sum())
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Inspection history tools.")
+    ap.add_argument("command", choices=["migrate", "digest"],
+                    help="migrate: rewrite legacy ResultsJSON as JSON; "
+                         "digest: e-mail overdue/due equipment (run from cron)")
+    ap.add_argument("--dry-run", action="store_true", help="print instead of writing/sending")
+    ap.add_argument("--days", type=int, default=None, help="due-soon window (default [app].due_days or 30)")
+    ap.add_argument("--to", action="append", help="digest recipient (default [app].digest_recipients)")
+    args = ap.parse_args()
+    if args.command == "migrate":
+        n = migrate_results_json(args.dry_run)
+        print(f"{n} rows {'to convert' if args.dry_run else 'converted'}")
+    else:
+        body = due_digest(args.days)
+        app_cfg = st.secrets.get("app", {})
+        to = args.to or app_cfg.get("digest_recipients") or app_cfg.get("default_recipients", [])
+        if args.dry_run or not to:
+            print(body)
+        else:
+            from mailer import send_email
+            send_email(to, f"Kalibreringsstatus {pd.Timestamp.now():%Y-%m-%d}", body)
+            print(f"digest sent to {', '.join(to)}")
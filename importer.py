@@ -0,0 +1,110 @@
+"""Bulk import of Equipment, Templates and TemplateItems from CSV/XLSX.
+
+Rows are deduplicated and upserted in memory against the current tab using a
+dict keyed on the normalized key columns, then committed with one write per
+tab, however many rows the file has.
+
+    python importer.py fleet.xlsx                  # every sheet named like a tab
+    python importer.py equipment.csv --tab Equipment
+"""
+import argparse, os
+import pandas as pd
+from storage import DB_SHEETS, read_sheet, write_sheet, norm
+
+# key columns (case/space insensitive) -> columns updated on a key hit
+IMPORT_KEYS = {
+    "Equipment": (["Type","Brand","Model","Serial"], ["Notes"]),
+    "Templates": (["Type","Brand","Model"], ["Template"]),
+    "TemplateItems": (["Template","Item"], ["Instruction"]),
+}
+# non-key columns a row must also fill in (a template without a name is useless)
+IMPORT_REQUIRED = {"Templates": ["Template"]}
+
+def _clean(v) -> str:
+    return "" if v is None or v != v else str(v).strip()
+
+def merge_rows(existing: pd.DataFrame, incoming: pd.DataFrame, name: str):
+    """Upsert `incoming` into `existing` in memory.
+
+    Returns (merged DataFrame, {"inserted", "updated", "skipped"}). Rows with a
+    blank key or required column are skipped, as are rows identical to what is stored and
+    earlier duplicates within the file (the last row for a key wins).
+    """
+    keys, update_cols = IMPORT_KEYS[name]
+    required = keys + IMPORT_REQUIRED.get(name, [])
+    missing = [c for c in required if c not in incoming.columns]
+    if missing:
+        raise ValueError(f"{name}: missing column(s) {', '.join(missing)}")
+    records = existing[DB_SHEETS[name]].to_dict(orient="records")
+    index = {}
+    for i, r in enumerate(records):
+        index.setdefault(tuple(norm(r[c]) for c in keys), i)
+    counts = {"inserted": 0, "updated": 0, "skipped": 0}
+    cols = [c for c in DB_SHEETS[name] if c in incoming.columns]
+    latest = {}  # dedupe the file first: last row per key wins
+    for rec in incoming[cols].to_dict(orient="records"):
+        rec = {c: _clean(rec.get(c)) for c in DB_SHEETS[name]}
+        k = tuple(norm(rec[c]) for c in keys)
+        ok = all(k) and all(rec[c] for c in required)
+        if not ok or k in latest:
+            counts["skipped"] += 1
+        if ok:
+            latest[k] = rec
+    for k, rec in latest.items():
+        i = index.get(k)
+        if i is None:
+            index[k] = len(records)
+            records.append(rec)
+            counts["inserted"] += 1
+            continue
+        changed = {c: rec[c] for c in update_cols
+                   if c in incoming.columns and _clean(records[i][c]) != rec[c]}
+        if changed:
+            records[i].update(changed)
+            counts["updated"] += 1
+        else:
+            counts["skipped"] += 1
+    return pd.DataFrame(records, columns=DB_SHEETS[name]), counts
+
+def import_frame(name: str, incoming: pd.DataFrame, dry_run: bool = False) -> dict:
+    """Upsert a DataFrame into a tab with a single batched write."""
+    merged, counts = merge_rows(read_sheet(name), incoming, name)
+    if not dry_run and (counts["inserted"] or counts["updated"]):
+        write_sheet(name, merged)
+    return counts
+
+def read_import_file(path: str, tab: str = None) -> dict:
+    """{tab: DataFrame} from a CSV (needs `tab`) or an XLSX (sheets named like tabs)."""
+    if path.lower().endswith(".xls"):
+        raise ValueError(f"{os.path.basename(path)}: old .xls files are not supported, save it as .xlsx or CSV")
+    if path.lower().endswith(".xlsx"):
+        sheets = pd.read_excel(path, sheet_name=None, dtype=str, engine="openpyxl")
+        if tab:
+            if tab in sheets:
+                return {tab: sheets[tab]}
+            if len(sheets) == 1:  # a one-sheet workbook is taken to be the tab
+                return {tab: next(iter(sheets.values()))}
+            raise ValueError(f"{os.path.basename(path)}: no sheet named {tab} "
+                             f"(sheets: {', '.join(map(str, sheets))})")
+        return {n: df for n, df in sheets.items() if n in IMPORT_KEYS}
+    if not tab:
+        raise ValueError("CSV import needs --tab (Equipment, Templates or TemplateItems)")
+    return {tab: pd.read_csv(path, dtype=str)}
+
+def import_file(path: str, tab: str = None, dry_run: bool = False) -> dict:
+    """Import a CSV/XLSX file; returns counts per tab."""
+    frames = read_import_file(path, tab)
+    if not frames:
+        raise ValueError(f"{os.path.basename(path)}: no sheet named {', '.join(IMPORT_KEYS)}")
+    # Templates before TemplateItems so a file can bring both
+    return {n: import_frame(n, frames[n], dry_run) for n in IMPORT_KEYS if n in frames}
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Bulk import Equipment/Templates/TemplateItems.")
+    ap.add_argument("path", help="CSV or XLSX file")
+    ap.add_argument("--tab", choices=list(IMPORT_KEYS), help="target tab (required for CSV)")
+    ap.add_argument("--dry-run", action="store_true", help="report counts without writing")
+    args = ap.parse_args()
+    for name, c in import_file(args.path, args.tab, args.dry_run).items():
+        print(f"{name}: {c['inserted']} inserted, {c['updated']} updated, {c['skipped']} skipped")
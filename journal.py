@@ -0,0 +1,212 @@
+"""Local write-ahead journal for log rows and equipment upserts.
+
+journal_append() and journal_upsert() write the change to an append-only
+file on local disk (fsynced), apply it to the cached tab so the app sees it
+at once, and return. A background flusher sends pending entries to the
+backend in batches (one append, or one diff write for upserts, per tab per
+flush) and retries with exponential backoff; entries left over from a
+previous run are sent when the flusher starts.
+
+Files in [app].journal_dir (default "journal"):
+
+    pending.jsonl   one JSON entry per line, in write order
+    done.jsonl      ids of the entries that reached the backend
+
+Both are truncated once everything is flushed. Delivery is at least once:
+a crash between sending a batch and recording it resends that batch.
+
+On by default with the Google Sheets backend; [app].journal = false turns it
+off (then the functions write through directly). [app].journal_delay
+(default 2) is how many seconds entries wait to be batched; under steady
+traffic a batch goes out anyway once its oldest entry has waited
+MAX_WAIT_FACTOR times that. A tab that fails backs off on its own; the
+other tabs keep flushing.
+"""
+import json, logging, os, threading, time, uuid
+import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx
+from storage import (append_sheet, append_remote, upsert, append_local, upsert_local, get_backend,
+                     invalidate_sheet, set_pending_source)
+from perf import timer
+
+log = logging.getLogger(__name__)
+
+POLL_SEC = 1.0
+BACKOFF_BASE_SEC = 5
+BACKOFF_MAX_SEC = 10 * 60
+MAX_WAIT_FACTOR = 5  # oldest entry waits at most this many journal_delay
+
+
+def _journal_settings() -> dict:
+    cfg = st.secrets.get("app", {})
+    return {
+        "enabled": bool(cfg.get("journal", cfg.get("backend", "sheets") == "sheets")),
+        "dir":     cfg.get("journal_dir", "journal"),
+        "delay":   float(cfg.get("journal_delay", 2)),
+    }
+
+def _append_line(path: str, data: dict) -> None:
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(data, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def _read_lines(path: str) -> list:
+    out = []
+    if not os.path.exists(path):
+        return out
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                out.append(json.loads(line))
+            except ValueError:
+                log.warning("skipping torn journal line in %s", path)  # only the last line after a crash
+    return out
+
+
+class JournalFlusher(threading.Thread):
+    """Sends journal entries to the backend; one per process."""
+
+    def __init__(self, cfg: dict):
+        super().__init__(name="kma-journal", daemon=True)
+        self.cfg = cfg
+        os.makedirs(cfg["dir"], exist_ok=True)
+        self.pending_path = os.path.join(cfg["dir"], "pending.jsonl")
+        self.done_path = os.path.join(cfg["dir"], "done.jsonl")
+        self.lock = threading.Lock()  # guards both files
+        self.ours = set()             # ids written by this process (already in the cache)
+        self._wake = threading.Event()
+        self._retry = {}              # tab -> (failures, next try), for tabs backing off
+        self.errors = {}              # tab -> last error while backing off
+        self.flushed = 0
+
+    def write(self, entry: dict) -> None:
+        entry = {"id": uuid.uuid4().hex, "created": time.time(), **entry}
+        with self.lock:
+            _append_line(self.pending_path, entry)
+            self.ours.add(entry["id"])
+        self._wake.set()
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    def pending(self) -> list:
+        with self.lock:
+            done = {d["id"] for d in _read_lines(self.done_path)}
+            return [e for e in _read_lines(self.pending_path) if e["id"] not in done]
+
+    @property
+    def last_error(self) -> str:
+        return "; ".join(f"{tab}: {e}" for tab, e in self.errors.items())
+
+    def pending_for(self, tab: str) -> list:
+        """Unsent entries for `tab`, oldest first."""
+        return [e for e in self.pending() if e["tab"] == tab]
+
+    def run(self):
+        while True:
+            self._wake.wait(POLL_SEC)
+            self._wake.clear()
+            try:
+                self.flush_once()
+            except Exception:
+                log.exception("journal flush failed")
+
+    def flush_once(self, force: bool = False) -> int:
+        """Send due entries, one batch per tab and operation. Returns entries sent."""
+        entries = self.pending()
+        if not entries:
+            return 0
+        now, delay = time.time(), self.cfg["delay"]
+        if not force and now - entries[-1]["created"] < delay \
+                and now - entries[0]["created"] < delay * MAX_WAIT_FACTOR:
+            return 0  # more may be on the way; the next poll comes back
+        sent = 0
+        for tab in dict.fromkeys(e["tab"] for e in entries):
+            failures, next_try = self._retry.get(tab, (0, 0.0))
+            if not force and now < next_try:
+                continue  # backing off; only this tab waits
+            batch = [e for e in entries if e["tab"] == tab]
+            try:
+                sent += self._send(tab, batch)
+            except Exception as e:
+                failures += 1
+                self._retry[tab] = (failures, now + min(BACKOFF_BASE_SEC * 2 ** (failures - 1), BACKOFF_MAX_SEC))
+                self.errors[tab] = str(e)
+                log.warning("journal flush of %s failed (attempt %d), retrying: %s", tab, failures, e)
+                continue
+            self._retry.pop(tab, None)
+            self.errors.pop(tab, None)
+        self.flushed += sent
+        self._compact()
+        return sent
+
+    def _send(self, tab: str, batch: list) -> int:
+        # each run of appends goes out as one append, each run of upserts as one write
+        backend, i = get_backend(), 0
+        while i < len(batch):
+            if batch[i]["op"] == "append":
+                j = i
+                while j < len(batch) and batch[j]["op"] == "append":
+                    j += 1
+                with timer("journal.append"):
+                    append_remote(tab, [r for e in batch[i:j] for r in e["rows"]])
+            else:
+                j = i
+                while j < len(batch) and batch[j]["op"] == "upsert":
+                    j += 1
+                with timer("journal.upsert"):
+                    backend.upsert_many(tab, [(e["rec"], e["update_cols"]) for e in batch[i:j]])
+            with self.lock:
+                for e in batch[i:j]:
+                    _append_line(self.done_path, {"id": e["id"]})
+            i = j
+        if any(e["id"] not in self.ours for e in batch):
+            invalidate_sheet(tab)  # replayed from an earlier run: the cache never saw these rows
+        return len(batch)
+
+    def _compact(self) -> None:
+        with self.lock:
+            done = {d["id"] for d in _read_lines(self.done_path)}
+            if all(e["id"] in done for e in _read_lines(self.pending_path)):
+                for path in (self.pending_path, self.done_path):
+                    open(path, "w").close()
+                self.ours.clear()
+
+
+@st.cache_resource
+def journal_flusher() -> JournalFlusher:
+    """The process-wide flusher, started on first use (replays anything left from a previous run)."""
+    f = JournalFlusher(_journal_settings())
+    set_pending_source(f.pending_for)  # reads of a tab not cached yet still see its unsent rows
+    add_script_run_ctx(f)  # _send goes through get_backend() / the sheet cache (st.cache_resource)
+    f.start()
+    return f
+
+def journal_enabled() -> bool:
+    return _journal_settings()["enabled"]
+
+def journal_append(name: str, rows: list) -> None:
+    """append_sheet() that returns once the rows are on local disk."""
+    if not rows:
+        return
+    if not journal_enabled():
+        return append_sheet(name, rows)
+    rows = [{k: "" if v is None else str(v) for k, v in r.items()} for r in rows]
+    journal_flusher().write({"op": "append", "tab": name, "rows": rows})
+    append_local(name, rows)
+
+def journal_upsert(name: str, rec, update_cols) -> bool:
+    """upsert() that returns once the change is on local disk. True if the row is new."""
+    if not journal_enabled():
+        return upsert(name, rec, update_cols)
+    rec = {k: "" if v is None else str(v) for k, v in rec.items()}
+    journal_flusher().write({"op": "upsert", "tab": name, "rec": rec, "update_cols": list(update_cols)})
+    return upsert_local(name, rec, update_cols)
+
+def journal_status() -> dict:
+    """Entries not yet sent, plus the last error if the flusher is backing off."""
+    if not journal_enabled():
+        return {"pending": 0, "last_error": ""}
+    f = journal_flusher()
+    return {"pending": len(f.pending()), "last_error": f.last_error}
@@ -0,0 +1,249 @@
+"""E-mail delivery for reports.
+
+send_email() sends synchronously. queue_email() writes the message to a
+durable outbox on local disk and returns at once; a background worker thread
+delivers it over a reused, authenticated SMTP connection, retrying with
+exponential backoff. Reports queued for the same recipients within
+[smtp].merge_window seconds go out as one message with several attachments.
+
+Settings come from st.secrets["smtp"]: host, port, user, password,
+sender_email, sender_name, plus the optional starttls (default true),
+outbox_dir (default "outbox"), merge_window (default 5), max_merge
+(default 10) and max_attempts (default 8).
+
+For local testing, point [smtp] at a debugging server and turn off TLS/login:
+
+    python -m aiosmtpd -n -l localhost:1025      # host="localhost", port=1025,
+                                                 # starttls=false, user=""
+"""
+import base64, json, logging, os, smtplib, threading, time, uuid
+from email.message import EmailMessage
+import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx
+from perf import timed, timer
+
+log = logging.getLogger(__name__)
+
+POLL_SEC = 1.0
+IDLE_CLOSE_SEC = 60     # drop the pooled SMTP connection after this much idle time
+BACKOFF_BASE_SEC = 15
+BACKOFF_MAX_SEC = 30 * 60
+
+
+def _smtp_settings() -> dict:
+    smtp_cfg = st.secrets["smtp"]  # will raise a clear error if [smtp] is missing
+    user = smtp_cfg.get("user", "")
+    return {
+        "host":         smtp_cfg["host"],
+        "port":         int(smtp_cfg.get("port", 587)),
+        "user":         user,
+        "password":     smtp_cfg.get("password", ""),
+        "sender_email": smtp_cfg.get("sender_email", user),
+        "sender_name":  smtp_cfg.get("sender_name", "KMA App"),
+        "starttls":     bool(smtp_cfg.get("starttls", True)),
+        "outbox_dir":   smtp_cfg.get("outbox_dir", "outbox"),
+        "merge_window": float(smtp_cfg.get("merge_window", 5)),
+        "max_merge":    int(smtp_cfg.get("max_merge", 10)),
+        "max_attempts": int(smtp_cfg.get("max_attempts", 8)),
+    }
+
+def _connect(cfg: dict) -> smtplib.SMTP:
+    s = smtplib.SMTP(cfg["host"], cfg["port"], timeout=30)
+    if cfg["starttls"]:
+        s.starttls()
+    if cfg["user"]:
+        s.login(cfg["user"], cfg["password"])
+    return s
+
+def _build_message(cfg: dict, recipients, subject, body, attachments) -> EmailMessage:
+    msg = EmailMessage()
+    msg["Subject"] = subject
+    msg["From"] = f"{cfg['sender_name']} <{cfg['sender_email']}>"
+    msg["To"] = ", ".join(recipients)
+    msg.set_content(body)
+    for filename, data in attachments:
+        subtype = "zip" if filename.lower().endswith(".zip") else "pdf"
+        msg.add_attachment(data, maintype="application", subtype=subtype, filename=filename)
+    return msg
+
+
+@timed("send_email")
+def send_email(recipients, subject, body, pdf_bytes=None, filename=None):
+    """
+    Send a PDF as e-mail attachment using SMTP settings from st.secrets['smtp'].
+    Without pdf_bytes a plain text mail is sent.
+    """
+    cfg = _smtp_settings()
+    attachments = [(filename, pdf_bytes)] if pdf_bytes is not None else []
+    msg = _build_message(cfg, recipients, subject, body, attachments)
+    with _connect(cfg) as s:
+        s.send_message(msg)
+
+
+# ----------------- Outbox -----------------
+def _write_json(path: str, data: dict) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def queue_email(recipients, subject, body, pdf_bytes=None, filename=None, attachments=None) -> str:
+    """Put a report e-mail in the outbox and return its id; delivery happens in the background.
+
+    `attachments` is a list of (filename, bytes), PDFs or a .zip, for mails
+    carrying several files; otherwise `pdf_bytes`/`filename` is the one PDF.
+    """
+    if attachments is None:
+        attachments = [(filename, pdf_bytes)]
+    cfg = _smtp_settings()
+    os.makedirs(cfg["outbox_dir"], exist_ok=True)
+    job_id = f"{time.time():.6f}-{uuid.uuid4().hex[:8]}"
+    now = time.time()
+    _write_json(os.path.join(cfg["outbox_dir"], job_id + ".json"), {
+        "id": job_id,
+        "created": now,
+        "next_try": now,
+        "attempts": 0,
+        "last_error": "",
+        "recipients": list(recipients),
+        "subject": subject,
+        "body": body,
+        "attachments": [{"filename": name, "data": base64.b64encode(data).decode("ascii")}
+                        for name, data in attachments],
+    })
+    outbox_worker().wake()
+    return job_id
+
+
+class OutboxWorker(threading.Thread):
+    """Delivers queued e-mails; one per process, holding one pooled SMTP connection."""
+
+    def __init__(self, cfg: dict):
+        super().__init__(name="kma-outbox", daemon=True)
+        self.cfg = cfg
+        self.dir = cfg["outbox_dir"]
+        self.failed_dir = os.path.join(self.dir, "failed")
+        self._wake = threading.Event()
+        self._conn = None
+        self._last_used = 0.0
+        self.sent = 0
+        self.errors = 0
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    def run(self):
+        while True:
+            try:
+                self.flush_once()
+            except Exception:
+                log.exception("outbox flush failed")
+            if self._conn and time.monotonic() - self._last_used > IDLE_CLOSE_SEC:
+                self._drop_connection()
+            self._wake.wait(POLL_SEC)
+            self._wake.clear()
+
+    def _connection(self) -> smtplib.SMTP:
+        if self._conn is not None:
+            try:
+                if self._conn.noop()[0] == 250:
+                    return self._conn
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._drop_connection()
+        self._conn = _connect(self.cfg)
+        return self._conn
+
+    def _drop_connection(self) -> None:
+        if self._conn is not None:
+            try:
+                self._conn.quit()
+            except Exception:
+                pass
+            self._conn = None
+
+    def _pending(self) -> list:
+        jobs = []
+        for fn in sorted(os.listdir(self.dir)) if os.path.isdir(self.dir) else []:
+            if not fn.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.dir, fn), encoding="utf-8") as f:
+                    jobs.append(json.load(f))
+            except (OSError, ValueError):
+                log.warning("skipping unreadable outbox entry %s", fn)
+        return jobs
+
+    def flush_once(self, now: float = None) -> int:
+        """Send every due job (merged per recipient set). Returns messages sent."""
+        now = time.time() if now is None else now
+        groups = {}
+        for job in self._pending():
+            # hold fresh jobs for the merge window so a burst goes out as one mail
+            if job["next_try"] > now or now - job["created"] < self.cfg["merge_window"]:
+                continue
+            key = tuple(sorted(r.strip().lower() for r in job["recipients"]))
+            groups.setdefault(key, []).append(job)
+        sent = 0
+        for jobs in groups.values():
+            for i in range(0, len(jobs), self.cfg["max_merge"]):
+                sent += self._send_batch(jobs[i:i + self.cfg["max_merge"]], now)
+        return sent
+
+    def _send_batch(self, jobs: list, now: float) -> int:
+        if len(jobs) == 1:
+            subject, body = jobs[0]["subject"], jobs[0]["body"]
+        else:
+            subject = f"{jobs[0]['subject']} (+{len(jobs) - 1} flere)"
+            body = "Se vedhæftede PDF'er.\n\n" + "\n\n---\n\n".join(j["subject"] + "\n" + j["body"] for j in jobs)
+        attachments = [(a["filename"], base64.b64decode(a["data"])) for j in jobs for a in j["attachments"]]
+        msg = _build_message(self.cfg, jobs[0]["recipients"], subject, body, attachments)
+        try:
+            with timer("smtp.send"):
+                self._connection().send_message(msg)
+            self._last_used = time.monotonic()
+        except Exception as e:
+            self.errors += 1
+            self._drop_connection()
+            for job in jobs:
+                self._retry_later(job, e, now)
+            return 0
+        for job in jobs:
+            try:
+                os.remove(os.path.join(self.dir, job["id"] + ".json"))
+            except FileNotFoundError:
+                pass
+        self.sent += 1
+        return 1
+
+    def _retry_later(self, job: dict, err: Exception, now: float) -> None:
+        job["attempts"] += 1
+        job["last_error"] = str(err)
+        path = os.path.join(self.dir, job["id"] + ".json")
+        if job["attempts"] >= self.cfg["max_attempts"]:
+            os.makedirs(self.failed_dir, exist_ok=True)
+            _write_json(os.path.join(self.failed_dir, job["id"] + ".json"), job)
+            os.remove(path)
+            log.error("giving up on e-mail %s after %d attempts: %s", job["id"], job["attempts"], err)
+            return
+        job["next_try"] = now + min(BACKOFF_BASE_SEC * 2 ** (job["attempts"] - 1), BACKOFF_MAX_SEC)
+        _write_json(path, job)
+        log.warning("e-mail %s failed (attempt %d), retrying: %s", job["id"], job["attempts"], err)
+
+
+@st.cache_resource
+def outbox_worker() -> OutboxWorker:
+    """The process-wide outbox worker, started on first use (picks up jobs left from a previous run)."""
+    w = OutboxWorker(_smtp_settings())
+    add_script_run_ctx(w)  # timer() records into perf's st.cache_resource state
+    w.start()
+    return w
+
+def outbox_status() -> dict:
+    """Pending/failed counts for the outbox."""
+    cfg = _smtp_settings()
+    d, failed = cfg["outbox_dir"], os.path.join(cfg["outbox_dir"], "failed")
+    count = lambda p: len([f for f in os.listdir(p) if f.endswith(".json")]) if os.path.isdir(p) else 0
+    return {"pending": count(d), "failed": count(failed)}
@@ -0,0 +1,147 @@
+"""Timing and counters for the hot paths.
+
+Off unless [app].perf = true in secrets. Functions are wrapped with
+@timed("name") and remote calls with `with timer("sheets.<op>")`; when
+perf is off both just call through. When on, every sample is kept (last
+SAMPLES per name) for p50/p95, each Streamlit rerun is totalled per step
+(time, Sheets API calls, time per operation), and one JSON line per rerun
+is logged to the "kma.perf" logger, plus [app].perf_log if set.
+"""
+import functools, json, logging, threading, time
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+log = logging.getLogger("kma.perf")
+
+SAMPLES = 2000   # per operation
+RERUNS = 1000    # per process
+API_PREFIX = "sheets."
+
+_enabled = None
+_rerun = threading.local()  # the rerun being totalled on this script thread
+
+def perf_enabled() -> bool:
+    """[app].perf, read once per process."""
+    global _enabled
+    if _enabled is None:
+        try:
+            cfg = st.secrets.get("app", {})
+        except Exception:  # no secrets file, e.g. CLI tools
+            cfg = {}
+        _enabled = bool(cfg.get("perf", False))
+        if _enabled and cfg.get("perf_log"):
+            handler = logging.FileHandler(cfg["perf_log"], encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            log.addHandler(handler)
+            log.setLevel(logging.INFO)
+    return _enabled
+
+@st.cache_resource
+def _perf():
+    return {"lock": threading.Lock(), "samples": {}, "reruns": deque(maxlen=RERUNS)}
+
+def record(name: str, seconds: float) -> None:
+    h = _perf()
+    with h["lock"]:
+        samples = h["samples"].get(name)
+        if samples is None:
+            samples = h["samples"][name] = deque(maxlen=SAMPLES)
+        samples.append(seconds)
+    ops = getattr(_rerun, "ops", None)
+    if ops is not None:
+        n, total = ops.get(name, (0, 0.0))
+        ops[name] = (n + 1, total + seconds)
+
+def timed(name: str):
+    """Decorator: record the call's duration under `name` when perf is on."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not (_enabled if _enabled is not None else perf_enabled()):
+                return fn(*args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - t0)
+        return wrapper
+    return deco
+
+@contextmanager
+def timer(name: str):
+    """Context manager form of @timed, for single calls such as one API request."""
+    if not (_enabled if _enabled is not None else perf_enabled()):
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - t0)
+
+
+# ----------------- Per rerun -----------------
+def start_rerun(step) -> None:
+    """Call at the top of the script; totals everything until end_rerun()."""
+    if not perf_enabled():
+        return
+    if getattr(_rerun, "ops", None) is not None:
+        end_rerun(interrupted=True)  # st.rerun()/st.stop() skipped the end of the last one
+    _rerun.step, _rerun.t0, _rerun.ops = step, time.perf_counter(), {}
+
+def end_rerun(interrupted: bool = False) -> None:
+    ops = getattr(_rerun, "ops", None)
+    if ops is None:
+        return
+    _rerun.ops = None
+    entry = {
+        "event": "rerun",
+        "step": _rerun.step,
+        "seconds": round(time.perf_counter() - _rerun.t0, 4),
+        "api_calls": sum(n for name, (n, _) in ops.items() if name.startswith(API_PREFIX)),
+        "interrupted": interrupted,
+        "ops": {name: {"count": n, "seconds": round(s, 4)} for name, (n, s) in ops.items()},
+    }
+    h = _perf()
+    with h["lock"]:
+        h["reruns"].append(entry)
+    log.info(json.dumps(entry, ensure_ascii=False))
+
+
+# ----------------- Reports -----------------
+def op_stats() -> pd.DataFrame:
+    """Count, p50/p95/max and total milliseconds per operation."""
+    h = _perf()
+    with h["lock"]:
+        samples = {name: np.array(s) * 1000 for name, s in h["samples"].items()}
+    rows = [{"Operation": name, "Count": len(ms),
+             "p50ms": round(float(np.percentile(ms, 50)), 2), "p95ms": round(float(np.percentile(ms, 95)), 2),
+             "MaxMs": round(float(ms.max()), 2), "TotalSec": round(float(ms.sum()) / 1000, 3)}
+            for name, ms in samples.items() if len(ms)]
+    return pd.DataFrame(rows, columns=["Operation","Count","p50ms","p95ms","MaxMs","TotalSec"]) \
+        .sort_values("TotalSec", ascending=False, ignore_index=True)
+
+def rerun_stats() -> pd.DataFrame:
+    """Per step: reruns, p50/p95 rerun time and Sheets API calls per rerun."""
+    h = _perf()
+    with h["lock"]:
+        reruns = pd.DataFrame(list(h["reruns"]), columns=["step","seconds","api_calls"])
+    if reruns.empty:
+        return pd.DataFrame(columns=["Step","Reruns","p50ms","p95ms","ApiCallsMean","ApiCallsMax"])
+    g = reruns.groupby("step")
+    return pd.DataFrame({
+        "Reruns": g.size(),
+        "p50ms": (g["seconds"].quantile(0.5) * 1000).round(1),
+        "p95ms": (g["seconds"].quantile(0.95) * 1000).round(1),
+        "ApiCallsMean": g["api_calls"].mean().round(2),
+        "ApiCallsMax": g["api_calls"].max(),
+    }).rename_axis("Step").reset_index()
+
+def reset_perf() -> None:
+    h = _perf()
+    with h["lock"]:
+        h["samples"].clear()
+        h["reruns"].clear()
@@ -0,0 +1,260 @@
+"""PDF certificates / inspection reports.
+
+gen_pdf() renders one report. Styles, table styles and the fixed paragraphs
+(company header, Banedanmark note, footer) are built once per process and
+reused for every report.
+
+render_bulk() re-renders many Inspections rows in a process pool, e.g. after
+a template wording change or for an audit:
+
+    python report_pdf.py --since 2024-01-01 --until 2024-12-31 --out 2024.zip
+    python report_pdf.py --csv inspections.csv --out pdfs/ --workers 8
+"""
+import argparse, copy, os, re, sys, time, zipfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from io import BytesIO
+from reportlab.lib.pagesizes import A4
+from reportlab.lib import colors
+from reportlab.lib.units import mm
+from reportlab.platypus import Table, TableStyle, Paragraph, SimpleDocTemplate, Spacer
+from reportlab.lib.styles import ParagraphStyle
+from reportlab.lib.enums import TA_RIGHT
+from history import parse_results
+from perf import timed
+
+# Styles
+h1  = ParagraphStyle('h1', fontName='Helvetica-Bold', fontSize=16, leading=18, spaceAfter=6)
+h2  = ParagraphStyle('h2', fontName='Helvetica-Bold', fontSize=12, leading=14, spaceAfter=6)
+txt = ParagraphStyle('txt', fontName='Helvetica', fontSize=10, leading=12)
+small = ParagraphStyle('small', fontName='Helvetica', fontSize=9, leading=11)
+right = ParagraphStyle('right', parent=small, alignment=TA_RIGHT)
+
+FIELDS_STYLE = TableStyle([('VALIGN',(0,0),(-1,-1),'TOP'), ('BOTTOMPADDING',(0,0),(-1,-1),4)])
+TRI_STYLE = TableStyle([
+    ('BOX',(0,0),(-1,-1),0.3,colors.black),
+    ('INNERGRID',(0,0),(-1,-1),0.3,colors.black),
+    ('BACKGROUND',(0,0),(-1,0), colors.whitesmoke),
+    ('VALIGN',(0,0),(-1,-1),'MIDDLE'),
+    ('ALIGN',(0,0),(-1,0),'CENTER'),
+])
+CHECKLIST_STYLE = TableStyle([
+    ('VALIGN',(0,0),(-1,-1),'TOP'),
+    ('ALIGN',(1,0),(1,-1),'RIGHT'),
+    ('BOTTOMPADDING',(0,0),(-1,-1),3),
+])
+
+# Fixed text, parsed once. gen_pdf uses shallow copies so concurrent builds
+# never share a flowable's layout state.
+_HEADER = [
+    Paragraph("Nordic Maskin & Rail.", h2),
+    Paragraph("Krumtappen 5, 6580 Vamdrup", txt),
+    Paragraph("CVR. 36078405", txt),
+]
+_TRI_HEAD = [
+    Paragraph("<b>Kalibreret til.</b>", txt),
+    Paragraph("<b>Ordre nr.</b>", txt),
+    Paragraph("<b>Kalibreret Dato</b>", txt),
+]
+_FIELD_LABELS = {k: Paragraph(f"<b>{k}</b>", txt) for k in ("Udstyr.", "Fabrikat.", "Serie nr.", "Bemærkning")}
+# Banedanmark note
+_BD_NOTE = Paragraph(
+    "Udstysr kalibreres if. GAB-Banedanmark anlæg & fornyelse. "
+    "General arbejdsbeskrivelse for sporarbejde.(GAB spor) udgave 14 af. "
+    "D.4-4-2016 pct. 2.6.1.1", small)
+_FOOTER = Paragraph("Revision 03-03-2022  Udarbejdet: SH    Kontrolleret: TJ    Godkendt: DCS", small)
+
+def _c(flowable):
+    return copy.copy(flowable)
+
+def map_status(s):
+    return {"green":"OK", "yellow":"ATTENTION", "red":"NOT OK"}.get((s or "").lower(), "-")
+
+
+@timed("gen_pdf")
+def gen_pdf(report_dict) -> bytes:
+    buf = BytesIO()
+
+    # Document
+    doc = SimpleDocTemplate(
+        buf, pagesize=A4,
+        leftMargin=18*mm, rightMargin=18*mm,
+        topMargin=16*mm, bottomMargin=14*mm
+    )
+
+    story = []
+
+    # Header
+    story.extend(_c(p) for p in _HEADER)
+    story.append(Spacer(1, 6))
+
+    title = "Kalibreringscertifikat" if report_dict["Action"].lower().startswith("kalibr") else "Service inspektionsrapport"
+    story.append(Paragraph(title, h1))
+    story.append(Spacer(1, 6))
+
+    # Equipment fields
+    fields = [
+        ("Udstyr.",  f"{report_dict['Type']}"),
+        ("Fabrikat.",f"{report_dict['Brand']}"),
+        ("Serie nr.",f"{report_dict['Model']}"),  # swap to Serial if you prefer
+        ("Bemærkning", report_dict.get("Comment","")),
+    ]
+    t = Table(
+        [[_c(_FIELD_LABELS[k]), Paragraph(v or "", txt)] for k,v in fields],
+        colWidths=[30*mm, 140*mm], hAlign='LEFT'
+    )
+    t.setStyle(FIELDS_STYLE)
+    story.append(t)
+    story.append(Spacer(1, 4))
+
+    # 3-column line
+    cal_to = report_dict.get("CalibratedTo","")
+    ordno  = report_dict.get("OrderNo","")
+    kdate  = report_dict["Timestamp"].split(" ")[0]
+    tri = [
+        [_c(p) for p in _TRI_HEAD],
+        [Paragraph(cal_to or "", txt),
+         Paragraph(ordno or "", txt),
+         Paragraph(kdate, txt)]
+    ]
+    t3 = Table(tri, colWidths=[50*mm, 40*mm, 40*mm])
+    t3.setStyle(TRI_STYLE)
+    story.append(t3)
+    story.append(Spacer(1, 8))
+
+    # Checklist
+    cl_rows = []
+    for r in report_dict["Results"]:
+        left = f"- {r['item']}"
+        note = r.get('note') or ""
+        if note: left += f" — {note}"
+        cl_rows.append([Paragraph(left, txt), Paragraph(map_status(r.get('status')), right)])
+
+    if cl_rows:
+        cl = Table(cl_rows, colWidths=[130*mm, 40*mm], hAlign='LEFT')
+        cl.setStyle(CHECKLIST_STYLE)
+        story.append(cl)
+        story.append(Spacer(1, 6))
+
+    story.append(_c(_BD_NOTE))
+    story.append(Spacer(1, 8))
+
+    # Next date + Kontrolleret af
+    story.append(Paragraph(f"Næste kontrol dato: {report_dict['NextDate']}", h2))
+    story.append(Paragraph(f"Kontrolleret af: {report_dict['User']}", h2))
+    story.append(Spacer(1, 14))
+
+    # Footer
+    story.append(_c(_FOOTER))
+
+    doc.build(story)
+    return buf.getvalue()
+
+
+def pdf_filename(report_dict, stamp: str = None) -> str:
+    """Kalibrering_<Type>_<Brand>_<Model>_<Serial>_<stamp>.pdf (stamp defaults to now)."""
+    base_name = "Kalibrering" if str(report_dict["Action"]).lower().startswith("kalibr") else "Service"
+    stamp = stamp or datetime.now().strftime('%Y%m%d_%H%M%S')
+    parts = [base_name] + [str(report_dict[k]) for k in ("Type", "Brand", "Model", "Serial")] + [stamp]
+    return re.sub(r'[\\/:*?"<>|]+', "-", "_".join(parts)) + ".pdf"
+
+
+# ----------------- Bulk -----------------
+def inspection_to_report(row) -> dict:
+    """An Inspections row -> the report dict gen_pdf expects."""
+    report = {k: "" if row.get(k) is None else str(row.get(k)) for k in
+              ("Timestamp", "User", "Action", "Type", "Brand", "Model", "Serial", "Comment", "NextDate")}
+    report["Results"] = parse_results(row.get("ResultsJSON"))
+    report["CalibratedTo"] = str(row.get("CalibratedTo", "") or "")
+    report["OrderNo"] = str(row.get("OrderNo", "") or "")
+    return report
+
+def inspection_filename(report) -> str:
+    """pdf_filename stamped with the inspection's own Timestamp."""
+    try:
+        stamp = datetime.strptime(report["Timestamp"], "%Y-%m-%d %H:%M").strftime("%Y%m%d_%H%M%S")
+    except ValueError:
+        stamp = re.sub(r"\D", "", report["Timestamp"]) or "unknown"
+    return pdf_filename(report, stamp)
+
+def _render_row(row):
+    report = inspection_to_report(row)
+    return inspection_filename(report), gen_pdf(report)
+
+def render_bulk(rows, out: str, workers: int = None) -> dict:
+    """Render many Inspections rows (dicts) into a directory or a .zip file.
+
+    Rendering runs in a process pool across all cores (or `workers`).
+    Returns {"count", "seconds", "per_second", "bytes"}.
+    """
+    rows = list(rows)
+    to_zip = out.lower().endswith(".zip")
+    if not to_zip:
+        os.makedirs(out, exist_ok=True)
+    seen, total = set(), 0
+    t0 = time.perf_counter()
+    zf = zipfile.ZipFile(out, "w", zipfile.ZIP_STORED) if to_zip else None  # PDFs are already compressed
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunk = max(1, len(rows) // ((workers or os.cpu_count() or 1) * 4))
+            for name, data in pool.map(_render_row, rows, chunksize=chunk):
+                stem, n = name[:-4], 1
+                while name in seen:  # same equipment inspected twice in one minute
+                    n += 1
+                    name = f"{stem}_{n}.pdf"
+                seen.add(name)
+                total += len(data)
+                if zf:
+                    zf.writestr(name, data)
+                else:
+                    with open(os.path.join(out, name), "wb") as f:
+                        f.write(data)
+    finally:
+        if zf:
+            zf.close()
+    secs = time.perf_counter() - t0
+    return {"count": len(rows), "seconds": secs,
+            "per_second": len(rows) / secs if secs else 0.0, "bytes": total}
+
+def _load_rows(args) -> list:
+    import pandas as pd
+    if args.csv:
+        df = pd.read_excel(args.csv, dtype=str) if args.csv.lower().endswith((".xlsx", ".xls")) \
+            else pd.read_csv(args.csv, dtype=str)
+    else:
+        from storage import read_log  # needs the app's secrets; reads only the partitions in range
+        df = read_log("Inspections", args.since, args.until)
+    df = df.fillna("")
+    ts = df["Timestamp"].astype(str)
+    if args.since:
+        df = df[ts >= args.since]
+    if args.until:
+        df = df[ts.loc[df.index] <= args.until + " 99"]  # inclusive of the whole day
+    if args.model:
+        df = df[df["Model"].astype(str).str.strip().str.lower() == args.model.strip().lower()]
+    if args.serial:
+        df = df[df["Serial"].astype(str).str.strip().str.lower() == args.serial.strip().lower()]
+    return df.to_dict(orient="records")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Re-render inspection PDFs in bulk.")
+    ap.add_argument("--out", required=True, help="output directory, or a .zip file")
+    ap.add_argument("--csv", help="read rows from a CSV/XLSX export instead of the Inspections tab")
+    ap.add_argument("--since", help="first date (YYYY-MM-DD)")
+    ap.add_argument("--until", help="last date (YYYY-MM-DD)")
+    ap.add_argument("--model", help="only this model")
+    ap.add_argument("--serial", help="only this serial")
+    ap.add_argument("--workers", type=int, default=None, help="processes (default: all cores)")
+    args = ap.parse_args()
+    rows = _load_rows(args)
+    stats = render_bulk(rows, args.out, args.workers)
+    print(f"{stats['count']} PDFs, {stats['bytes'] / 1e6:.1f} MB in {stats['seconds']:.1f}s "
+          f"({stats['per_second']:.1f} PDFs/s) -> {args.out}")
+    # CalibratedTo/OrderNo are only logged since they got their own columns; older
+    # calibrations re-render without them and are not identical to what was sent
+    lossy = sum(1 for r in rows if str(r.get("Action", "")).lower().startswith("kalibr")
+                and not str(r.get("CalibratedTo", "") or "").strip())
+    if lossy:
+        print(f"warning: {lossy} calibration(s) have no stored CalibratedTo/OrderNo; "
+              f"their PDFs lack those fields", file=sys.stderr)
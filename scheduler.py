@@ -0,0 +1,145 @@
+"""Quota-aware scheduling of Google Sheets API calls.
+
+Every SheetsBackend request goes through sheets_call(), which
+
+  * coalesces identical reads already in flight (single flight): when a
+    dozen sessions ask for Users at once, one request is made and all of
+    them get its response;
+  * takes a token from a bucket sized to [app].sheets_quota_per_min
+    (default 60, the Sheets per-user quota): up to [app].sheets_burst
+    (default a quarter of the quota) at once, then a steady rate that keeps
+    every minute under the quota, so bursts queue instead of tripping it;
+  * retries 429 and 5xx responses (and dropped connections, for idempotent
+    calls) with full-jitter exponential backoff, then raises SheetsBusyError.
+
+SheetsScheduler takes its clock and sleep as arguments so it can be tested
+against bench.FakeSpreadsheet(quota_per_min=...) without waiting; see
+`python bench.py --quota`.
+"""
+import random, threading, time
+import streamlit as st
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+EPSILON = 1e-9
+
+class SheetsBusyError(RuntimeError):
+    """The Sheets API kept refusing a request (quota or outage) after all retries."""
+
+
+def _status(err):
+    code = getattr(err, "code", None)  # gspread.exceptions.APIError
+    if code is None:
+        code = getattr(getattr(err, "response", None), "status_code", None)
+    return code
+
+def retryable(err, idempotent: bool = True) -> bool:
+    """A 429 was never applied, so it is always retried; 5xx and dropped connections
+    (requests' exceptions are OSErrors) only when repeating the call is harmless."""
+    code = _status(err)
+    if code == 429:
+        return True
+    return idempotent and (code in RETRY_STATUS or (code is None and isinstance(err, OSError)))
+
+
+class TokenBucket:
+    """`rate` tokens per second, at most `capacity` banked."""
+
+    def __init__(self, rate: float, capacity: float, clock=time.monotonic, sleep=time.sleep):
+        self.rate, self.capacity = rate, capacity
+        self.clock, self.sleep = clock, sleep
+        self.tokens, self.updated = capacity, clock()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Take one token, waiting for it if needed. Returns seconds waited."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1 - EPSILON:  # refills are floats: 0.9999999999999998 is a token
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+            waited += wait
+
+
+class SheetsScheduler:
+    """Single flight + token bucket + jittered retries around Sheets API calls."""
+
+    def __init__(self, per_minute: float = 60, burst: float = None, retries: int = 6,
+                 backoff_base: float = 1.0, backoff_max: float = 32.0,
+                 clock=time.monotonic, sleep=time.sleep, rng=random.random):
+        burst = float(burst or max(1.0, per_minute / 4))
+        # refill at quota minus burst, so no 60 s window can see more than the quota
+        self.bucket = TokenBucket(max(per_minute - burst, 1.0) / 60.0, burst, clock, sleep)
+        self.retries, self.backoff_base, self.backoff_max = retries, backoff_base, backoff_max
+        self.sleep, self.rng = sleep, rng
+        self._lock = threading.Lock()
+        self._inflight = {}  # key -> {"done": Event, "result", "error"}
+        self.stats = {"calls": 0, "coalesced": 0, "retries": 0, "throttled_sec": 0.0, "failed": 0}
+
+    def call(self, fn, key=None, idempotent: bool = True):
+        """Run fn() under the quota. Calls sharing a non-None `key` while one is
+        in flight wait for that one's result instead of making their own."""
+        if key is None:
+            return self._run(fn, idempotent)
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = {"done": threading.Event(), "result": None, "error": None}
+            else:
+                self.stats["coalesced"] += 1
+        if not leader:
+            flight["done"].wait()
+            if flight["error"] is not None:
+                raise flight["error"]
+            return flight["result"]
+        try:
+            flight["result"] = self._run(fn, idempotent)
+            return flight["result"]
+        except BaseException as e:
+            flight["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight["done"].set()
+
+    def _run(self, fn, idempotent: bool):
+        attempt = 0
+        while True:
+            waited = self.bucket.acquire()
+            with self._lock:
+                self.stats["calls"] += 1
+                self.stats["throttled_sec"] += waited
+            try:
+                return fn()
+            except Exception as e:
+                if not retryable(e, idempotent):
+                    raise
+                if attempt >= self.retries:
+                    with self._lock:
+                        self.stats["failed"] += 1
+                    raise SheetsBusyError(
+                        "Google Sheets svarer ikke lige nu (kvote eller driftsforstyrrelse). "
+                        "Prøv igen om et øjeblik.") from e
+                attempt += 1
+                with self._lock:
+                    self.stats["retries"] += 1
+                self.sleep(self.rng() * min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+
+@st.cache_resource
+def sheets_scheduler() -> SheetsScheduler:
+    """The process-wide scheduler shared by every session."""
+    cfg = st.secrets.get("app", {})
+    per_minute = float(cfg.get("sheets_quota_per_min", 60))
+    return SheetsScheduler(per_minute, cfg.get("sheets_burst"))
+
+def sheets_call(fn, key=None, idempotent: bool = True):
+    """sheets_scheduler().call(); see SheetsScheduler.call."""
+    return sheets_scheduler().call(fn, key, idempotent)
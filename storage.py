@@ -0,0 +1,891 @@
+"""Persistence for the KMA app.
+
+Everything the app stores lives in the tabs described by DB_SHEETS. The tabs
+are served by a backend selected with [app].backend in secrets:
+
+    "sheets"  the KMA_DB Google Sheet (default)
+    "sqlite"  a local SQLite file ([app].sqlite_path, default kma.db) with
+              indexed point lookups; mirror it to the Sheet with
+              `python storage.py sync`
+
+read_sheet/write_sheet/append_sheet keep the same DataFrame contract for both.
+With the Sheets backend, Inspections and Logins can be split into one tab per
+year or month ([app].log_partition, see "Log partitions" below).
+"""
+import argparse, sqlite3, threading, time
+import streamlit as st
+import numpy as np
+import pandas as pd
+from perf import timed, timer
+from scheduler import sheets_call
+
+DB_SHEETS = {
+    "Users": ["FullName","PasswordHash","Email","IsActive"],
+    "Equipment": ["Type","Brand","Model","Serial","Notes"],
+    "Templates": ["Template","Type","Brand","Model"],
+    "TemplateItems": ["Template","Item","Instruction"],
+    "Inspections": ["Timestamp","User","Action","Type","Brand","Model","Serial","ResultsJSON","Comment","NextDate","PdfPath","Recipients","CalibratedTo","OrderNo"],
+    "Logins": ["Timestamp","User","Action","Equipment","NextDate"],
+}
+
+# Columns that identify a row for lookup()/upsert(); compared case/space insensitive
+KEY_COLUMNS = {
+    "Users": ["FullName"],
+    "Equipment": ["Type","Brand","Model","Serial"],
+    "Templates": ["Type","Brand","Model"],
+    "TemplateItems": ["Template"],
+}
+
+def norm(x) -> str:
+    """Normalize a single value (case/space insensitive, robust to numbers)."""
+    return str("" if x is None else x).strip().lower()
+
+def sser(s: pd.Series) -> pd.Series:
+    """Normalize a pandas Series (handles NaN / numbers)."""
+    return s.fillna("").astype(str).str.strip().str.lower()
+
+def _key(name: str, rec) -> str:
+    return "|".join(norm(rec.get(c)) for c in KEY_COLUMNS[name])
+
+
+# ----------------- Google Sheets -----------------
+def _gcp_creds():
+    from google.oauth2.service_account import Credentials  # gspread/google-auth load on first use
+    gcp_info = dict(st.secrets["gcp"])   # same as in your test app
+    scopes = [
+        "https://www.googleapis.com/auth/spreadsheets",
+        "https://www.googleapis.com/auth/drive.readonly",  # drive not used, but ok
+    ]
+    return Credentials.from_service_account_info(gcp_info, scopes=scopes)
+
+@st.cache_resource
+@timed("sheets.connect")
+def _gsheet_client():
+    creds = _gcp_creds()
+    import gspread
+    gc = gspread.authorize(creds)
+    sheet_id = st.secrets["app"]["spreadsheet_id"]
+    return sheets_call(lambda: gc.open_by_key(sheet_id))
+
+
+class Backend:
+    """Storage interface. Tabs and their columns are fixed by DB_SHEETS.
+
+    lookup() and upsert() have generic implementations on top of read/write
+    (filtering `df`, or the backend's own read() of the tab); backends with
+    real indexes override them and set `indexed`.
+    """
+
+    indexed = False  # lookup() queries an index, no need to pass it the tab
+
+    def read(self, name: str) -> pd.DataFrame:
+        raise NotImplementedError
+
+    def write(self, name: str, df: pd.DataFrame, base: pd.DataFrame = None) -> None:
+        """Replace the tab with `df`. `base` is the last snapshot read, if known."""
+        raise NotImplementedError
+
+    def append(self, name: str, rows: list) -> None:
+        raise NotImplementedError
+
+    def read_many(self, names) -> dict:
+        return {n: self.read(n) for n in names}
+
+    def ensure_tab(self, name: str) -> None:
+        """Make sure the tab exists (only log partitions can be missing)."""
+
+    def lookup(self, name: str, rec, df: pd.DataFrame = None) -> pd.DataFrame:
+        df = self.read(name) if df is None else df
+        mask = pd.Series(True, index=df.index)
+        for c in KEY_COLUMNS[name]:
+            mask &= sser(df[c]) == norm(rec.get(c))
+        return df[mask].reset_index(drop=True)
+
+    def upsert(self, name: str, rec, update_cols, df: pd.DataFrame = None) -> bool:
+        df = self.read(name) if df is None else df
+        inserted = len(self.lookup(name, rec, df)) == 0
+        self.write(name, _upsert_frame(df, name, rec, update_cols), base=df)
+        return inserted
+
+    def upsert_many(self, name: str, changes) -> None:
+        """Apply (rec, update_cols) pairs in order against the stored tab (not the cache), in one write."""
+        df = self.read(name)
+        new = df
+        for rec, update_cols in changes:
+            new = _upsert_frame(new, name, rec, update_cols)
+        self.write(name, new, base=df)
+
+
+def _values_to_frame(name: str, values) -> pd.DataFrame:
+    """Raw sheet values (header row first) -> DataFrame, like get_all_records."""
+    cols = _columns(name)
+    if not values:
+        return pd.DataFrame(columns=cols)
+    from gspread.utils import numericise_all
+    header, width = values[0], len(values[0])
+    rows = [numericise_all((r + [""] * width)[:width]) for r in values[1:]]
+    df = pd.DataFrame(rows, columns=header)
+    # ensure all expected columns exist, even for empty sheets
+    for col in cols:
+        if col not in df.columns:
+            df[col] = ""
+    return df[cols]
+
+
+def _cell(v) -> dict:
+    # RAW string, like ws.update(); an empty CellData clears the cell
+    return {"userEnteredValue": {"stringValue": v}} if v != "" else {}
+
+def _diff_requests(sheet_id: int, base: pd.DataFrame, df: pd.DataFrame) -> list:
+    """spreadsheets.batchUpdate requests that turn `base` into `df` (header excluded).
+
+    Rows are matched by position. Changed cells are sent as one updateCells
+    per run of adjacent columns, extra rows as a single appendCells and
+    missing rows are cleared. Untouched cells are not sent at all.
+    """
+    old = base.fillna("").astype(str).to_numpy()
+    new = df.fillna("").astype(str).to_numpy()
+    n, width = min(len(old), len(new)), new.shape[1]
+    requests = []
+    changed = old[:n] != new[:n]
+    for r in np.flatnonzero(changed.any(axis=1)):
+        cols = np.flatnonzero(changed[r])
+        # split into runs of adjacent columns
+        for run in np.split(cols, np.flatnonzero(np.diff(cols) != 1) + 1):
+            c0, c1 = int(run[0]), int(run[-1]) + 1
+            requests.append({"updateCells": {
+                "range": {"sheetId": sheet_id, "startRowIndex": int(r) + 1, "endRowIndex": int(r) + 2,
+                          "startColumnIndex": c0, "endColumnIndex": c1},
+                "rows": [{"values": [_cell(v) for v in new[r, c0:c1]]}],
+                "fields": "userEnteredValue",
+            }})
+    if len(old) > n:
+        requests.append({"updateCells": {
+            "range": {"sheetId": sheet_id, "startRowIndex": n + 1, "endRowIndex": len(old) + 1,
+                      "startColumnIndex": 0, "endColumnIndex": width},
+            "fields": "userEnteredValue",
+        }})
+    if len(new) > n:
+        requests.append({"appendCells": {
+            "sheetId": sheet_id,
+            "rows": [{"values": [_cell(v) for v in row]} for row in new[n:]],
+            "fields": "userEnteredValue",
+        }})
+    return requests
+
+
+class SheetsBackend(Backend):
+    """The KMA_DB Google Sheet; every call is a round trip to the Sheets API."""
+
+    def __init__(self):
+        self._header_ok = set()     # tabs whose header row is known to be complete
+        self._short_header = set()  # tabs read with a header missing newer columns
+        self._ws = {}               # name -> Worksheet, saves a metadata call per write
+
+    def _worksheet(self, name: str):
+        ws = self._ws.get(name)
+        if ws is None:
+            from gspread.exceptions import WorksheetNotFound
+            try:
+                with timer("sheets.worksheet"):
+                    ws = sheets_call(lambda: _gsheet_client().worksheet(name), key=("worksheet", name))
+            except WorksheetNotFound:
+                # a new log partition: create the tab
+                with timer("sheets.add_worksheet"):
+                    ws = sheets_call(lambda: _gsheet_client().add_worksheet(name, rows=1000, cols=len(_columns(name))),
+                                     key=("add_worksheet", name), idempotent=False)
+            self._ws[name] = ws
+        return ws
+
+    def ensure_tab(self, name: str) -> None:
+        """Create the tab if it is missing and give it its full header row."""
+        ws = self._worksheet(name)
+        if name not in self._header_ok:
+            # a fresh tab has no header yet, an older one may lack columns added
+            # since (appended at the end); write it once so get_all_records works
+            cols = _columns(name)
+            with timer("sheets.row_values"):
+                header = sheets_call(lambda: ws.row_values(1), key=("row_values", name, 1))
+            if not header or (len(header) < len(cols) and header == cols[:len(header)]):
+                with timer("sheets.update"):
+                    sheets_call(lambda: ws.update([cols], "A1"))
+            self._header_ok.add(name)
+            self._short_header.discard(name)
+
+    def read(self, name: str) -> pd.DataFrame:
+        return self.read_many([name])[name]
+
+    def read_many(self, names) -> dict:
+        """All requested tabs in one spreadsheets.values.batchGet round trip.
+
+        Sessions asking for the same tabs at the same moment share one request.
+        """
+        names = list(names)
+        with timer("sheets.values_batch_get"):
+            res = sheets_call(lambda: _gsheet_client().values_batch_get([f"'{n}'" for n in names]),
+                              key=("values_batch_get", tuple(names)))
+        ranges = res.get("valueRanges", [])
+        out = {}
+        for n, vr in zip(names, ranges):
+            values = vr.get("values", [])
+            if values and len(values[0]) < len(_columns(n)):
+                self._short_header.add(n)  # cells written past it would be dropped on read
+            out[n] = _values_to_frame(n, values)
+        return out
+
+    def write(self, name: str, df: pd.DataFrame, base: pd.DataFrame = None) -> None:
+        if base is not None and list(base.columns) == list(df.columns):
+            if name in self._short_header:
+                self.ensure_tab(name)
+            requests = _diff_requests(self._worksheet(name).id, base, df)
+            if requests:
+                with timer("sheets.batch_update"):
+                    # cell updates can be repeated safely; appendCells would add the rows twice
+                    sheets_call(lambda: _gsheet_client().batch_update({"requests": requests}),
+                                idempotent=not any("appendCells" in r for r in requests))
+            return
+        ws = self._worksheet(name)
+        df = df.copy()
+        df = df.fillna("")
+        values = [df.columns.tolist()] + df.astype(str).values.tolist()
+        with timer("sheets.clear"):
+            sheets_call(ws.clear)
+        with timer("sheets.update"):
+            sheets_call(lambda: ws.update(values))
+
+    def append(self, name: str, rows: list) -> None:
+        self.ensure_tab(name)
+        ws, cols = self._worksheet(name), _columns(name)
+        values = [["" if r.get(c) is None else str(r.get(c)) for c in cols] for r in rows]
+        with timer("sheets.append_rows"):
+            # not idempotent: only a 429 (never applied) is retried
+            sheets_call(lambda: ws.append_rows(values, value_input_option="RAW", table_range="A1"),
+                        idempotent=False)
+
+
+# ----------------- SQLite -----------------
+# Extra indexes per table (beyond the normalized _key index)
+SQLITE_INDEXES = {
+    "Equipment": [["Type","Brand","Model","Serial"]],
+    "Templates": [["Template"]],
+    "Inspections": [["Timestamp"]],
+}
+
+class SQLiteBackend(Backend):
+    """Local SQLite file with the DB_SHEETS schema.
+
+    Keyed tabs carry a hidden `_key` column (the normalized KEY_COLUMNS joined
+    with "|") with an index on it, so lookup()/upsert() are single indexed
+    queries instead of full-tab scans. All values are stored as TEXT, like the
+    strings write_sheet sends to Google Sheets.
+    """
+
+    indexed = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            for name, cols in DB_SHEETS.items():
+                defs = ", ".join(f'"{c}" TEXT' for c in cols)
+                if name in KEY_COLUMNS:
+                    defs += ", _key TEXT"
+                self._con.execute(f'CREATE TABLE IF NOT EXISTS "{name}" ({defs})')
+                have = {r[1] for r in self._con.execute(f'PRAGMA table_info("{name}")')}
+                for c in cols:
+                    if c not in have:  # column added to DB_SHEETS after the file was created
+                        self._con.execute(f'ALTER TABLE "{name}" ADD COLUMN "{c}" TEXT')
+                if name in KEY_COLUMNS:
+                    self._con.execute(f'CREATE INDEX IF NOT EXISTS "ix_{name}__key" ON "{name}"(_key)')
+                for idx_cols in SQLITE_INDEXES.get(name, []):
+                    ix = f'ix_{name}_' + "_".join(idx_cols)
+                    on = ", ".join(f'"{c}"' for c in idx_cols)
+                    self._con.execute(f'CREATE INDEX IF NOT EXISTS "{ix}" ON "{name}"({on})')
+
+    def _cols(self, name: str) -> str:
+        return ", ".join(f'"{c}"' for c in DB_SHEETS[name])
+
+    def _rows(self, name: str, records) -> list:
+        cols = DB_SHEETS[name]
+        out = []
+        for r in records:
+            row = ["" if r.get(c) is None or r.get(c) != r.get(c) else str(r.get(c)) for c in cols]
+            if name in KEY_COLUMNS:
+                row.append(_key(name, r))
+            out.append(row)
+        return out
+
+    def _insert_sql(self, name: str) -> str:
+        n = len(DB_SHEETS[name]) + (1 if name in KEY_COLUMNS else 0)
+        cols = self._cols(name) + (", _key" if name in KEY_COLUMNS else "")
+        return f'INSERT INTO "{name}" ({cols}) VALUES ({", ".join("?" * n)})'
+
+    def read(self, name: str) -> pd.DataFrame:
+        with self._lock:
+            cur = self._con.execute(f'SELECT {self._cols(name)} FROM "{name}" ORDER BY rowid')
+            return pd.DataFrame(cur.fetchall(), columns=DB_SHEETS[name])
+
+    def write(self, name: str, df: pd.DataFrame, base: pd.DataFrame = None) -> None:
+        records = df.to_dict(orient="records")
+        with self._lock:
+            # one transaction: readers never see the tab half-written
+            self._con.execute("BEGIN IMMEDIATE")
+            try:
+                self._con.execute(f'DELETE FROM "{name}"')
+                self._con.executemany(self._insert_sql(name), self._rows(name, records))
+                self._con.execute("COMMIT")
+            except Exception:
+                self._con.execute("ROLLBACK")
+                raise
+
+    def append(self, name: str, rows: list) -> None:
+        with self._lock:
+            self._con.execute("BEGIN IMMEDIATE")
+            try:
+                self._con.executemany(self._insert_sql(name), self._rows(name, rows))
+                self._con.execute("COMMIT")
+            except Exception:
+                self._con.execute("ROLLBACK")
+                raise
+
+    def lookup(self, name: str, rec, df: pd.DataFrame = None) -> pd.DataFrame:
+        with self._lock:
+            cur = self._con.execute(
+                f'SELECT {self._cols(name)} FROM "{name}" WHERE _key = ? ORDER BY rowid',
+                (_key(name, rec),),
+            )
+            return pd.DataFrame(cur.fetchall(), columns=DB_SHEETS[name])
+
+    def upsert(self, name: str, rec, update_cols, df: pd.DataFrame = None) -> bool:
+        with self._lock:
+            self._con.execute("BEGIN IMMEDIATE")
+            try:
+                hit = self._con.execute(
+                    f'SELECT rowid FROM "{name}" WHERE _key = ? ORDER BY rowid LIMIT 1',
+                    (_key(name, rec),),
+                ).fetchone()
+                if hit:
+                    sets = ", ".join(f'"{c}" = ?' for c in update_cols)
+                    vals = [str(rec.get(c, "") or "") for c in update_cols]
+                    self._con.execute(f'UPDATE "{name}" SET {sets} WHERE rowid = ?', vals + [hit[0]])
+                else:
+                    self._con.executemany(self._insert_sql(name), self._rows(name, [rec]))
+                self._con.execute("COMMIT")
+            except Exception:
+                self._con.execute("ROLLBACK")
+                raise
+        return not hit
+
+    def upsert_many(self, name: str, changes) -> None:
+        for rec, update_cols in changes:
+            self.upsert(name, rec, update_cols)
+
+
+@st.cache_resource
+def get_backend() -> Backend:
+    """The configured backend, shared by every session."""
+    cfg = st.secrets.get("app", {})
+    if cfg.get("backend", "sheets") == "sqlite":
+        return SQLiteBackend(cfg.get("sqlite_path", "kma.db"))
+    return SheetsBackend()
+
+
+# ----------------- Read cache -----------------
+# Seconds a tab stays cached before read_sheet goes back to the backend.
+# Override per tab in secrets, e.g. [app.cache_ttl] Equipment = 600
+CACHE_TTL = {
+    "Users": 300,
+    "Equipment": 300,
+    "Templates": 900,
+    "TemplateItems": 900,
+    "Inspections": 3600,  # large; this process's own writes go through the cache
+    "Logins": 60,
+    "Partitions": 60,
+}
+
+STALE = float("-inf")  # loaded_at of an invalidated entry (frame kept for comparison)
+
+@st.cache_resource
+def _sheet_cache():
+    """Process-wide tab cache, shared by every session and kept across reruns."""
+    return {
+        "lock": threading.Lock(),
+        "tabs": {},        # name -> (loaded_at, DataFrame)
+        "versions": {},    # name -> int, bumped whenever the tab contents change
+        "hits": {},        # name -> int
+        "misses": {},      # name -> int
+        "loading": {},     # name -> Event, set when the read in flight for it lands
+        "pending": None,   # fn(tab) -> journal entries not sent yet (set by journal.py)
+    }
+
+def _cache_ttl(name: str) -> float:
+    overrides = st.secrets.get("app", {}).get("cache_ttl", {})
+    base = base_tab(name)
+    if base != name and name.rsplit("_", 1)[1] not in _open_periods():
+        return float(overrides.get("closed_partitions", CLOSED_PARTITION_TTL))
+    return float(overrides.get(base, CACHE_TTL.get(base, 0)))
+
+def _bump(cache, name: str) -> None:
+    cache["versions"][name] = cache["versions"].get(name, 0) + 1
+
+def _same(a: pd.DataFrame, b: pd.DataFrame) -> bool:
+    # compare as strings: the Sheets API numericises cells we wrote as text
+    return a.shape == b.shape and a.astype(str).equals(b.astype(str))
+
+def invalidate_sheet(name: str = None) -> None:
+    """Mark one tab (with its log partitions) or all tabs stale so the next read goes to the backend."""
+    cache = _sheet_cache()
+    with cache["lock"]:
+        names = list(cache["tabs"])
+        if name:
+            names = [name] + [n for n in names if n.startswith(name + "_")] \
+                + ([MANIFEST] if name in PARTITIONED else [])
+        for n in names:
+            if n in cache["tabs"]:
+                cache["tabs"][n] = (STALE, cache["tabs"][n][1])
+            _bump(cache, n)
+
+def sheet_cache_stats() -> pd.DataFrame:
+    """Hit/miss counters and current age per tab, for tuning CACHE_TTL."""
+    cache = _sheet_cache()
+    now = time.monotonic()
+    rows = []
+    with cache["lock"]:
+        for name in list(DB_SHEETS) + sorted(n for n in cache["tabs"] if n not in DB_SHEETS):
+            hits, misses = cache["hits"].get(name, 0), cache["misses"].get(name, 0)
+            entry = cache["tabs"].get(name)
+            rows.append({
+                "Tab": name,
+                "Hits": hits,
+                "Misses": misses,
+                "HitRate": round(hits / (hits + misses), 3) if hits + misses else None,
+                "AgeSec": round(now - entry[0], 1) if entry and entry[0] != STALE else None,
+                "TTLSec": _cache_ttl(name),
+                "Version": cache["versions"].get(name, 0),
+            })
+    return pd.DataFrame(rows)
+
+def _frames(names) -> dict:
+    """Cached frames for several tabs, refreshing all expired ones in one backend call.
+
+    Callers must not mutate the returned frames.
+    """
+    cache = _sheet_cache()
+    out, entries, versions, waits = {}, {}, {}, {}
+    now = time.monotonic()
+    with cache["lock"]:
+        for name in names:
+            entry = cache["tabs"].get(name)
+            if entry and now - entry[0] < _cache_ttl(name):
+                cache["hits"][name] = cache["hits"].get(name, 0) + 1
+                out[name] = entry[1]
+            elif name in cache["loading"]:
+                waits[name] = cache["loading"][name]  # e.g. the warm-up is already reading it
+            else:
+                cache["misses"][name] = cache["misses"].get(name, 0) + 1
+                entries[name], versions[name] = entry, cache["versions"].get(name, 0)
+                cache["loading"][name] = threading.Event()
+    if entries:
+        try:
+            fetched = get_backend().read_many(list(entries))
+            fetched = {name: _with_pending(cache, name, df) for name, df in fetched.items()}
+            with cache["lock"]:
+                for name, df in fetched.items():
+                    out[name] = df
+                    if cache["versions"].get(name, 0) != versions[name]:
+                        continue  # written while we were reading; don't cache a stale copy
+                    entry = entries[name]
+                    if not (entry and _same(entry[1], df)):
+                        _bump(cache, name)
+                    cache["tabs"][name] = (time.monotonic(), df)
+        finally:
+            with cache["lock"]:
+                for name in entries:
+                    cache["loading"].pop(name).set()
+    if waits:
+        for event in waits.values():
+            event.wait()
+        out.update(_frames(list(waits)))  # cached now, or read again if that read failed
+    return out
+
+def _with_pending(cache, name: str, df: pd.DataFrame) -> pd.DataFrame:
+    """A frame just read from the backend plus the journal's unsent changes to it,
+    so a tab that was not cached when they were made still shows them."""
+    entries = cache["pending"](base_tab(name)) if cache["pending"] else []
+    if not entries:
+        return df
+    base = base_tab(name)
+    # rows sent while we were reading are already at the end of the tab
+    tail = df.tail(sum(len(e.get("rows", [])) for e in entries)).astype(str)
+    seen = set(tail.itertuples(index=False, name=None))
+    for e in entries:
+        if e["op"] == "upsert":
+            df = _upsert_frame(df, name, e["rec"], e["update_cols"])
+            continue
+        rows = e["rows"]
+        if partitioned(base):
+            periods = _periods(pd.Series([r.get(PARTITIONED[base]) for r in rows], dtype=object),
+                               _partition_scheme())
+            rows = [r for r, p in zip(rows, periods) if name == f"{base}_{p}"]
+        elif name != base:
+            rows = []
+        new = [[str(r.get(c, "")) for c in df.columns] for r in rows]
+        new = [r for r in new if tuple(r) not in seen]
+        if new:
+            df = pd.concat([df, pd.DataFrame(new, columns=df.columns)], ignore_index=True)
+    return df
+
+def set_pending_source(fn) -> None:
+    """Let fn(tab) supply unsent journal entries for fresh reads of `tab`."""
+    _sheet_cache()["pending"] = fn
+
+def _frame(name: str) -> pd.DataFrame:
+    return _frames([name])[name]
+
+def _patch_cached(name: str, fn) -> None:
+    """Apply a local write to the cached frame (write-through) and bump the version."""
+    cache = _sheet_cache()
+    with cache["lock"]:
+        entry = cache["tabs"].get(name)
+        if entry:
+            cache["tabs"][name] = (entry[0], fn(entry[1]))
+        _bump(cache, name)
+
+
+# ----------------- Log partitions -----------------
+# With [app].log_partition = "year" or "month" (Sheets backend only), the
+# append-only logs are split by the period of their Timestamp into tabs named
+# "<tab>_<period>", e.g. Inspections_2025 or Logins_2025-03. A new period's
+# tab is created on its first row. The Partitions tab (the manifest) lists
+# them, so reads fetch only the partitions a date range needs, and a tab whose
+# period is over is cached for CLOSED_PARTITION_TTL instead of being re-read
+# every minute. The original tab is always read first; it is empty once
+# `python storage.py partition` has moved its rows into partitions.
+PARTITIONED = {"Inspections": "Timestamp", "Logins": "Timestamp"}
+PARTITION_SCHEMES = {"year": 4, "month": 7}  # period = first n characters of the Timestamp
+MANIFEST = "Partitions"
+MANIFEST_COLUMNS = ["Tab","Period","Sheet"]
+UNDATED = "undated"  # partition for rows without a parseable Timestamp
+CLOSED_PARTITION_TTL = 24 * 3600
+
+def _columns(name: str) -> list:
+    return MANIFEST_COLUMNS if name == MANIFEST else DB_SHEETS[base_tab(name)]
+
+def base_tab(name: str) -> str:
+    """The DB_SHEETS tab a partition belongs to ("Inspections_2025" -> "Inspections")."""
+    return name.split("_", 1)[0]
+
+def _partition_scheme() -> str:
+    scheme = st.secrets.get("app", {}).get("log_partition", "none")
+    if scheme != "none" and scheme not in PARTITION_SCHEMES:
+        raise ValueError(f"[app].log_partition must be none, year or month, not {scheme!r}")
+    return scheme
+
+def partitioned(name: str) -> bool:
+    """True if the log `name` is stored as per-period partition tabs."""
+    return (name in PARTITIONED and _partition_scheme() != "none"
+            and isinstance(get_backend(), SheetsBackend))
+
+def _periods(ts: pd.Series, scheme: str) -> pd.Series:
+    s = ts.fillna("").astype(str).str.strip()
+    return s.str[:PARTITION_SCHEMES[scheme]].where(s.str.match(r"\d{4}-\d{2}"), UNDATED)
+
+def _open_periods() -> set:
+    """Periods that can still receive rows: the current one and, just after a
+    rollover, the previous one (journal entries written before midnight)."""
+    scheme = _partition_scheme()
+    if scheme == "none":
+        return set()
+    n = PARTITION_SCHEMES[scheme]
+    now = time.time()
+    return {time.strftime("%Y-%m-%d", time.localtime(t))[:n] for t in (now, now - 24 * 3600)}
+
+@st.cache_resource
+def _manifest_state():
+    return {"lock": threading.Lock(), "ready": False}
+
+def _manifest() -> pd.DataFrame:
+    state = _manifest_state()
+    with state["lock"]:
+        if not state["ready"]:
+            get_backend().ensure_tab(MANIFEST)
+            state["ready"] = True
+    return _frame(MANIFEST)
+
+def log_partitions(name: str, since: str = None, until: str = None) -> list:
+    """Partition tabs of a log in period order, limited to those that can hold
+    Timestamps between `since` and `until` (date strings, both inclusive)."""
+    m = _manifest()
+    m = m[m["Tab"].astype(str) == name]
+    parts = dict(zip(m["Period"].astype(str), m["Sheet"].astype(str)))  # duplicate registrations collapse
+    periods = sorted(parts, key=lambda p: (p != UNDATED, p))
+    if since or until:
+        periods = [p for p in periods if p != UNDATED
+                   and (not since or p >= since[:len(p)]) and (not until or p <= until[:len(p)])]
+    return [parts[p] for p in periods]
+
+def _log_tabs(name: str, since: str = None, until: str = None) -> list:
+    return [name] + log_partitions(name, since, until) if partitioned(name) else [name]
+
+def _log_frame(name: str, since: str = None, until: str = None) -> pd.DataFrame:
+    """The original tab followed by the partitions, as one frame (row numbers run across tabs)."""
+    tabs = _log_tabs(name, since, until)
+    frames = _frames(tabs)
+    parts = [frames[t] for t in tabs if len(frames[t])] or [frames[name]]
+    return pd.concat(parts, ignore_index=True)
+
+def _add_partitions(name: str, periods) -> dict:
+    """Create and register partition tabs; {period: tab}."""
+    backend, rows = get_backend(), []
+    for p in periods:
+        sheet = f"{name}_{p}"
+        backend.ensure_tab(sheet)  # before the manifest row, so readers never meet a missing tab
+        rows.append({"Tab": name, "Period": p, "Sheet": sheet})
+    if rows:
+        backend.append(MANIFEST, rows)
+        append_local(MANIFEST, rows)
+    return {r["Period"]: r["Sheet"] for r in rows}
+
+def _route(name: str, rows: list, create: bool = False) -> dict:
+    """{tab: rows} for rows of `name`: its partitions, or the tab itself."""
+    if not partitioned(name):
+        return {name: rows}
+    periods = _periods(pd.Series([r.get(PARTITIONED[name]) for r in rows], dtype=object), _partition_scheme())
+    groups = {}
+    for r, p in zip(rows, periods):
+        groups.setdefault(p, []).append(r)
+    m = _manifest()
+    m = m[m["Tab"].astype(str) == name]
+    known = dict(zip(m["Period"].astype(str), m["Sheet"].astype(str)))
+    if create:
+        known.update(_add_partitions(name, [p for p in groups if p not in known]))
+    return {known.get(p, f"{name}_{p}"): rs for p, rs in groups.items()}
+
+
+# ----------------- Public API -----------------
+@timed("read_sheet")
+def read_sheet(name: str) -> pd.DataFrame:
+    """Read a tab into a DataFrame (TTL-cached). A partitioned log comes back whole."""
+    return _log_frame(name) if partitioned(name) else _frame(name).copy()
+
+def read_sheets(names) -> dict:
+    """Read several tabs at once: {name: DataFrame}, one backend round trip for all misses."""
+    frames = _frames([n for n in names if not partitioned(n)])
+    return {n: frames[n].copy() if n in frames else read_sheet(n) for n in names}
+
+def read_log(name: str, since: str = None, until: str = None) -> pd.DataFrame:
+    """Rows of Inspections/Logins with a Timestamp between `since` and `until`
+    (date strings, both inclusive). Only the partitions covering the range are read."""
+    df = _log_frame(name, since, until)
+    ts = df[PARTITIONED[name]].fillna("").astype(str)
+    mask = pd.Series(True, index=df.index)
+    if since:
+        mask &= ts >= since
+    if until:
+        mask &= (ts <= until) | ts.str.startswith(until)
+    return df[mask].reset_index(drop=True)
+
+def sheet_versions(names) -> dict:
+    """sheet_version for several tabs, refreshing expired ones in one round trip."""
+    plain = [n for n in names if not partitioned(n)]
+    _frames(plain)
+    versions = _sheet_cache()["versions"]
+    return {n: versions.get(n, 0) if n in plain else sheet_version(n) for n in names}
+
+def sheet_version(name: str) -> int:
+    """Data version of a tab; changes whenever its contents change.
+
+    Lets derived structures (indexes, lookups) be rebuilt once per version
+    instead of once per rerun.
+    """
+    if not partitioned(name):
+        _frame(name)
+        return _sheet_cache()["versions"].get(name, 0)
+    tabs = [MANIFEST] + _log_tabs(name)
+    _frames(tabs)
+    versions = _sheet_cache()["versions"]
+    return sum(versions.get(t, 0) for t in tabs)  # versions only grow, so neither does the sum
+
+@timed("write_sheet")
+def write_sheet(name: str, df: pd.DataFrame) -> None:
+    """Write a DataFrame to a tab.
+
+    If the tab was read earlier in this process, only the cells that differ
+    from that snapshot (and any new rows) are sent, in one batch request.
+    A partitioned log can only be rewritten row for row (as read_sheet
+    returned it); new rows go through append_sheet.
+    """
+    if not partitioned(name):
+        return _write_tab(name, df)
+    tabs = _log_tabs(name)
+    frames = _frames(tabs)
+    if len(df) != sum(len(frames[t]) for t in tabs):
+        raise ValueError(f"{name} is partitioned: write_sheet cannot add or remove rows, use append_sheet")
+    start = 0
+    for t in tabs:
+        part = df.iloc[start:start + len(frames[t])].reset_index(drop=True)
+        start += len(part)
+        if not _same(frames[t], part):
+            _write_tab(t, part)
+
+def _write_tab(name: str, df: pd.DataFrame) -> None:
+    cache = _sheet_cache()
+    with cache["lock"]:
+        entry = cache["tabs"].get(name)
+    get_backend().write(name, df, base=entry[1] if entry else None)
+    written = df.copy()
+    _patch_cached(name, lambda _: written)
+
+def append_sheet(name: str, rows: list) -> None:
+    """Append rows (dicts keyed by DB_SHEETS columns) to a tab.
+
+    Unlike write_sheet this never reads or clears the tab, so the cost of a
+    log entry stays constant no matter how much history the tab holds.
+    """
+    if not rows:
+        return
+    append_remote(name, rows)
+    append_local(name, rows)
+
+def append_remote(name: str, rows: list) -> None:
+    """append_sheet() without touching the cache (journal.py patched it already).
+
+    Rows of a partitioned log go to the partition of their Timestamp; a new
+    period's tab is created and registered first.
+    """
+    backend = get_backend()
+    for tab, part in _route(name, rows, create=True).items():
+        backend.append(tab, part)
+
+def lookup(name: str, rec) -> pd.DataFrame:
+    """Rows of a keyed tab whose KEY_COLUMNS match `rec` (case/space insensitive)."""
+    backend = get_backend()
+    return backend.lookup(name, rec) if backend.indexed else backend.lookup(name, rec, _frame(name))
+
+def _upsert_frame(df: pd.DataFrame, name: str, rec, update_cols) -> pd.DataFrame:
+    mask = pd.Series(True, index=df.index)
+    for c in KEY_COLUMNS[name]:
+        mask &= sser(df[c]) == norm(rec.get(c))
+    df = df.copy()
+    if mask.any():
+        idx = df[mask].index[0]
+        for c in update_cols:
+            df.loc[idx, c] = rec.get(c, "")
+        return df
+    # Always write as strings to preserve leading zeros in Serial
+    new = {c: str(rec.get(c, "")) for c in DB_SHEETS[name]}
+    return pd.concat([df, pd.DataFrame([new])], ignore_index=True)
+
+def upsert(name: str, rec, update_cols) -> bool:
+    """Update `update_cols` of the row matching `rec` on KEY_COLUMNS, or append it.
+
+    Returns True if a new row was inserted.
+    """
+    backend = get_backend()
+    inserted = backend.upsert(name, rec, update_cols) if backend.indexed \
+        else backend.upsert(name, rec, update_cols, _frame(name))
+    _patch_cached(name, lambda df: _upsert_frame(df, name, rec, update_cols))
+    return inserted
+
+def append_local(name: str, rows: list) -> None:
+    """Show rows in the cached tab without sending them (journal.py sends them later).
+
+    Rows for a partition that is not registered yet appear once they are sent.
+    """
+    for tab, part in _route(name, rows).items():
+        new = pd.DataFrame([{c: "" if r.get(c) is None else str(r.get(c)) for c in _columns(tab)}
+                            for r in part])
+        _patch_cached(tab, lambda df, new=new: pd.concat([df, new], ignore_index=True))
+
+def upsert_local(name: str, rec, update_cols) -> bool:
+    """upsert() applied to the cached tab only. Returns True if the row is new."""
+    inserted = lookup(name, rec).empty
+    _patch_cached(name, lambda df: _upsert_frame(df, name, rec, update_cols))
+    return inserted
+
+
+# ----------------- Sync -----------------
+def sync_to_sheets(sqlite_path: str, tabs=None) -> dict:
+    """Mirror the SQLite tabs to the Google Sheet. Returns rows written per tab."""
+    src, dst = SQLiteBackend(sqlite_path), SheetsBackend()
+    written = {}
+    for name in tabs or DB_SHEETS:
+        df = src.read(name)
+        dst.write(name, df)
+        written[name] = len(df)
+    return written
+
+def load_from_sheets(sqlite_path: str, tabs=None) -> dict:
+    """Replace the SQLite tabs with the current Google Sheet contents."""
+    src, dst = SheetsBackend(), SQLiteBackend(sqlite_path)
+    loaded = {}
+    for name in tabs or DB_SHEETS:
+        df = src.read(name)
+        dst.write(name, df)
+        loaded[name] = len(df)
+    return loaded
+
+
+def partition_logs(tabs=None, dry_run: bool = False) -> dict:
+    """Move the rows of the original Inspections/Logins tabs into their partitions.
+
+    Needs [app].log_partition. The original tab is emptied only after every
+    partition is written, and rows already in a partition are not added
+    again, so an interrupted run can simply be repeated. Returns rows per
+    partition tab.
+    """
+    scheme = _partition_scheme()
+    backend = get_backend()
+    if scheme == "none" or not isinstance(backend, SheetsBackend):
+        raise ValueError('partitioning needs the sheets backend and [app].log_partition = "year" or "month"')
+    backend.ensure_tab(MANIFEST)
+    manifest = backend.read(MANIFEST)
+    moved = {}
+    for name in tabs or PARTITIONED:
+        if name not in PARTITIONED:
+            raise ValueError(f"{name} is not a log tab ({', '.join(PARTITIONED)})")
+        df = backend.read(name)
+        periods = _periods(df[PARTITIONED[name]], scheme)
+        known = set(manifest.loc[manifest["Tab"].astype(str) == name, "Period"].astype(str))
+        new = []
+        for p, part in df.groupby(periods, sort=True):
+            sheet = f"{name}_{p}"
+            moved[sheet] = len(part)
+            if dry_run:
+                continue
+            if p in known:  # rows the app appended after partitioning, or an earlier run
+                existing = backend.read(sheet)
+                part = pd.concat([part, existing], ignore_index=True)
+                part = part[~part.astype(str).duplicated()]
+            backend.write(sheet, part.reset_index(drop=True))
+            if p not in known:
+                new.append({"Tab": name, "Period": p, "Sheet": sheet})
+        if not dry_run and len(df):
+            if new:
+                backend.append(MANIFEST, new)
+            backend.write(name, df.iloc[0:0])
+    return moved
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Sync the local SQLite store with the KMA_DB Google Sheet.")
+    ap.add_argument("command", choices=["sync", "load", "partition"],
+                    help="sync: SQLite -> Sheet, load: Sheet -> SQLite, "
+                         "partition: move Inspections/Logins rows into per-period tabs")
+    ap.add_argument("--db", default=None, help="SQLite file (default: [app].sqlite_path or kma.db)")
+    ap.add_argument("--tab", action="append", choices=list(DB_SHEETS), help="limit to these tabs")
+    ap.add_argument("--dry-run", action="store_true", help="partition: only count the rows per partition")
+    args = ap.parse_args()
+    if args.command == "partition":
+        for sheet, n in partition_logs(args.tab, args.dry_run).items():
+            print(f"{sheet}: {n} rows")
+        if not args.dry_run:
+            print("Restart the app so running processes drop their cached copies of these tabs.")
+        raise SystemExit
+    path = args.db or st.secrets.get("app", {}).get("sqlite_path", "kma.db")
+    fn = sync_to_sheets if args.command == "sync" else load_from_sheets
+    for name, n in fn(path, args.tab).items():
+        print(f"{name}: {n} rows")